@@ -1,17 +1,135 @@
-import requests
 import json
+import hashlib
+import heapq
+import os
 import API_KEY
+import final_proj_db
 import time
 import random
-from bs4 import BeautifulSoup
-import sqlite3
-import plotly.graph_objs as go
+import itertools
+import threading
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 
 BASE_URL_SEARCH = 'https://api.yelp.com/v3/businesses/search?'
+LOCALE_URL = 'https://www.yelp.com/developers/documentation/v3/supported_locales'
 headers = {'Authorization': 'Bearer '+ f'{API_KEY.API_key}'}
 DBNAME = 'final_proj_fusion.sqlite'
-conn = sqlite3.connect(DBNAME)
-cur = conn.cursor()
+DB_POOL = None
+DB_POOL_LOCK = threading.Lock()
+META_TABLE_STATEMENT = '''
+    CREATE TABLE IF NOT EXISTS "Meta" (
+    "key"	TEXT NOT NULL,
+    "value"	TEXT,
+    PRIMARY KEY("key")
+    )
+'''
+STARTUP_BUDGET_MS = 75
+VERBOSE = True
+
+CACHE_FILENAME = 'cache_final_proj.json'
+CACHE_DBNAME = 'cache_final_proj.sqlite'
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+SEARCH_CACHE_TTL = 60 * 60 * 24
+HTML_CACHE_TTL = 60 * 60 * 24 * 30
+RESPONSE_CLASS_TTLS = {
+    'success': SEARCH_CACHE_TTL,
+    'empty': 60 * 60 * 6,
+    'client_error': 60 * 60 * 24,
+    'auth_error': 0,
+    'rate_limited': 60,
+    'server_error': 0,
+}
+MEMORY_CACHE_MAX_ENTRIES = 256
+MEMORY_CACHE_MAX_BYTES = 32 * 1024 * 1024
+CACHE_KEY_VERSION = '1'
+CACHE_KEY_DEFAULT_PARAMS = {'offset': '0'}
+SEARCH_PROJECTION_VERSION = 1
+CACHE_RAW_RESPONSES = False
+CACHE_STORE = None
+CACHE_STORE_LOCK = threading.Lock()
+API_MAX_QPS = 5
+API_BURST = 5
+API_DAILY_LIMIT = 5000
+TOKEN_BUCKET = None
+TOKEN_BUCKET_LOCK = threading.Lock()
+SINGLE_FLIGHT = None
+SINGLE_FLIGHT_LOCK = threading.Lock()
+HTTP_SESSION = None
+HTTP_SESSION_LOCK = threading.Lock()
+HTTP_TIMEOUT = 15
+HTTP_MAX_RETRIES = 4
+HTTP_BACKOFF_BASE = 0.5
+HTTP_BACKOFF_MAX = 30
+LATENCY_BUCKETS_MS = [25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+LATENCY_HISTOGRAMS = {}
+LATENCY_HISTOGRAMS_LOCK = threading.Lock()
+SEARCH_PAGE_SIZE = 50
+SEARCH_MAX_RESULTS = 200
+FETCH_WORKERS = 4
+MULTI_CITY_WORKERS = 4
+HTTP_POOL_SIZE = FETCH_WORKERS * MULTI_CITY_WORKERS
+BATCH_WORKERS = 4
+LOCALE_CODE_DICT = None
+CATEGORIES_FILENAME = 'categories.json'
+CATEGORY_INDEX_VERSION = 4
+CATEGORY_ROWS = None
+CATEGORY_INDEX = None
+COUNTRY_CATEGORY_ROWS = {}
+COUNTRY_CATEGORY_INDEX = {}
+CATEGORY_LOCK = threading.RLock()
+LOCALE_ID_DICT = None
+ACTIVE_WORKING_SET = None
+BUSINESS_SCHEMA_VERSION = '3'
+BUSINESS_TABLES_READY = False
+BUSINESS_INDEXES = [
+    ('BusinessCategory_category', 'BusinessCategory', '"category", "business_id"'),
+    ('Business_location_city', 'Business', '"location_city"'),
+    ('Business_rating', 'Business', '"rating"'),
+    ('Business_review_count', 'Business', '"review_count"'),
+    ('Business_price_level', 'Business', '"price_level"'),
+    ('SearchResult_recommendation_score', 'SearchResult', '"search_id", "recommendation_score"'),
+]
+QUERY_PLAN_CHECKS = [
+    ('businesses of a category in a city', '''
+        SELECT Business.id FROM BusinessCategory
+        JOIN Business ON BusinessCategory.business_id = Business.id
+        WHERE BusinessCategory.category = ? AND Business.location_city = ?
+    ''', ['Chinese', 'Ann Arbor'], False),
+    ('results of a search by score', '''
+        SELECT Business.name, SearchResult.recommendation_score
+        FROM SearchResult JOIN Business ON SearchResult.business_id = Business.id
+        WHERE SearchResult.search_id = ?
+        ORDER BY SearchResult.recommendation_score DESC
+    ''', [1], True),
+    ('best rated businesses', '''
+        SELECT Business.id FROM Business WHERE Business.rating >= ?
+        ORDER BY Business.rating DESC LIMIT 10
+    ''', [4.0], True),
+    ('most reviewed businesses', '''
+        SELECT Business.id FROM Business WHERE Business.review_count >= ?
+        ORDER BY Business.review_count DESC LIMIT 10
+    ''', [100], True),
+    ('cheapest businesses', '''
+        SELECT Business.id FROM Business WHERE Business.price_level < ?
+        ORDER BY Business.price_level ASC LIMIT 10
+    ''', [6], True),
+    ('categories of a search', '''
+        SELECT BusinessCategory.business_id, BusinessCategory.category
+        FROM SearchResult
+        JOIN BusinessCategory ON SearchResult.business_id = BusinessCategory.business_id
+        WHERE SearchResult.search_id = ?
+    ''', [1], False),
+]
+CARE_COLUMNS = ['price_level', 'rating', 'review_count']
+CARE_WEIGHTS = [0.6, 0.3, 0.1]
+SCORE_MATRIX_CACHE = OrderedDict()
+SCORE_MATRIX_CACHE_SIZE = 32
+SCORE_MATRIX_LOCK = threading.Lock()
+TOP_RECOMMENDATION_COUNT = 7
+CATEGORY_MATCH_COUNT = 5
 
 class Business:
     '''a yelp business
@@ -84,9 +202,224 @@ class Business:
         info_short_str += ', rating=' + str(self.rating) + ', price level=' + self.price_level
         return info_short_str
 
+class CategoryIndex:
+    '''a trigram index over category aliases and titles for ranked fuzzy search
+
+    Instance Attributes
+    -------------------
+    entries: list
+        a list of (alias, title) tuples
+
+    terms: list
+        a list of (entry position, lowercase term, trigram count) tuples,
+        one for the alias and one for the title of each entry
+
+    postings: dict
+        key is a trigram and value is a list of positions in terms
+    '''
+    def __init__(self, entries):
+        self.entries = list(entries)
+        self.terms = []
+        self.postings = {}
+        for entry_pos, (alias, title) in enumerate(self.entries):
+            for term in {alias.lower(), title.lower()}:
+                term_pos = len(self.terms)
+                term_grams = get_trigrams(term)
+                self.terms.append((entry_pos, term, len(term_grams)))
+                for gram in term_grams:
+                    self.postings.setdefault(gram, []).append(term_pos)
+
+    def search(self, query, k=CATEGORY_MATCH_COUNT):
+        ''' Find the categories most similar to a query.
+
+        Terms sharing trigrams with the query are shortlisted, then ranked
+        by the best of trigram overlap, prefix/substring match and edit
+        distance similarity, so typos are tolerated.
+
+        Parameters
+        ----------
+        query: string
+            user's input of a category
+
+        k: integer
+            the maximum number of candidates returned
+
+        Returns
+        -------
+        list
+            a list of (score, alias, title) tuples, best match first
+        '''
+        query = query.strip().lower()
+        if query == '':
+            return []
+        query_grams = get_trigrams(query)
+
+        overlap = {}
+        for gram in query_grams:
+            for term_pos in self.postings.get(gram, []):
+                overlap[term_pos] = overlap.get(term_pos, 0) + 1
+
+        query_gram_count = len(query_grams)
+        dice_scores = []
+        for term_pos, common in overlap.items():
+            dice_scores.append((2.0 * common / (query_gram_count + self.terms[term_pos][2]), term_pos))
+
+        best_score = {}
+        for score, term_pos in heapq.nlargest(k * 4, dice_scores):
+            entry_pos, term, term_gram_count = self.terms[term_pos]
+            if term.startswith(query):
+                score = max(score, 0.9)
+            elif query in term:
+                score = max(score, 0.8)
+            # the length difference bounds the edit distance from below
+            longest = max(len(query), len(term))
+            if 1.0 - abs(len(query) - len(term)) / longest > score:
+                distance = get_edit_distance(query, term)
+                score = max(score, 1.0 - distance / longest)
+            if score > best_score.get(entry_pos, 0.0):
+                best_score[entry_pos] = score
+
+        ranked = heapq.nlargest(k, best_score.items(), key=lambda item: item[1])
+        return [(score, self.entries[pos][0], self.entries[pos][1]) for pos, score in ranked]
+
+def get_trigrams(text):
+    ''' Split a text into its set of padded trigrams.
+
+    Parameters
+    ----------
+    text: string
+        a lowercase text
+
+    Returns
+    -------
+    set
+        a set of three-character strings
+    '''
+    padded = '  ' + text + ' '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def get_edit_distance(a, b):
+    ''' Compute the Levenshtein distance between two strings.
+
+    Parameters
+    ----------
+    a: string
+        the first string
+
+    b: string
+        the second string
+
+    Returns
+    -------
+    integer
+        the minimum number of insertions, deletions and substitutions
+    '''
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+def get_db_pool():
+    ''' Get the pool of per-thread connections to DBNAME. Nothing is
+    opened until a thread asks for its connection, so starting the program
+    or asking for help never touches the disk.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    ConnectionPool
+        the shared connection pool
+    '''
+    global DB_POOL
+    if DB_POOL is None:
+        with DB_POOL_LOCK:
+            if DB_POOL is None:
+                DB_POOL = final_proj_db.ConnectionPool(DBNAME)
+    return DB_POOL
+
+def get_connection():
+    ''' Get the connection of the calling thread to DBNAME.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    Connection
+        the sqlite connection of the calling thread
+    '''
+    return get_db_pool().get_connection()
+
+def get_cursor():
+    ''' Get the cursor of the calling thread on DBNAME.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    Cursor
+        the cursor of the calling thread
+    '''
+    return get_db_pool().get_cursor()
+
+def get_meta(key):
+    ''' Read a value from the Meta table of the database.
+
+    Parameters
+    ----------
+    key: string
+        the name of the stored value
+
+    Returns
+    -------
+    string
+        the stored value, None if it does not exist
+    '''
+    get_cursor().execute(META_TABLE_STATEMENT)
+    row = get_cursor().execute('SELECT Meta.value FROM Meta WHERE Meta.key = ?', [key]).fetchone()
+    if row is None:
+        return None
+    return row[0]
+
+def set_meta(key, value):
+    ''' Write a value into the Meta table of the database, without
+    committing so that it joins the caller's transaction.
+
+    Parameters
+    ----------
+    key: string
+        the name of the stored value
+
+    value: string
+        the value to be stored
+
+    Returns
+    -------
+    None
+    '''
+    get_cursor().execute('INSERT OR REPLACE INTO Meta VALUES (?, ?)', [key, value])
+
 def get_locale_code():
     ''' Get locale code of supported country of this app.
 
+    The parsed map is kept for the whole process and persisted in the
+    Locale table together with a hash of the locale page, so the page is
+    only parsed again when its cached content changes. Rows are updated in
+    place by country, so the Id a Business row refers to stays the same
+    when the page changes.
+
     Parameters
     ----------
     None
@@ -97,96 +430,364 @@ def get_locale_code():
         key is a country name in lowercase without space and 
         value is a yelp supported country code
     '''
-    locale_url = 'https://www.yelp.com/developers/documentation/v3/supported_locales'
-    CACHE_DICT = load_cache()
-    locale_response = make_url_request_using_cache_html(locale_url, CACHE_DICT)
+    global LOCALE_CODE_DICT
+    with CATEGORY_LOCK:
+        if LOCALE_CODE_DICT is not None:
+            return LOCALE_CODE_DICT
+
+        cache = load_cache()
+        locale_response = make_url_request_using_cache_html(LOCALE_URL, cache)
+        locale_hash = hashlib.sha1(locale_response.encode('utf-8')).hexdigest()
+
+        sql_statement = '''
+        CREATE TABLE IF NOT EXISTS "Locale" (
+        "Id"	INTEGER,
+        "country"	TEXT,
+        "locale_code"	TEXT,
+        "alpha2"	TEXT,
+        PRIMARY KEY("Id" AUTOINCREMENT)
+        )
+        '''
+        get_cursor().execute(sql_statement)
+        get_cursor().execute('CREATE UNIQUE INDEX IF NOT EXISTS "Locale_country" ON "Locale" ("country")')
 
-    locale_soup = BeautifulSoup(locale_response, 'html.parser')
-    locale_list_parent = locale_soup.find('tbody').find_all('tr')
+        if get_meta('locale_hash') == locale_hash:
+            sql_statement = '''
+            SELECT Locale.country, Locale.locale_code FROM Locale
+            ORDER BY Locale.Id ASC
+            '''
+            LOCALE_CODE_DICT = dict(get_cursor().execute(sql_statement).fetchall())
+            return LOCALE_CODE_DICT
 
-    locale_code = {}
-    for locale in locale_list_parent:
-        locale_content = locale.find_all('td')
+        # bs4 is only needed when the page changed
+        from bs4 import BeautifulSoup
+        locale_soup = BeautifulSoup(locale_response, 'html.parser')
+        locale_list_parent = locale_soup.find('tbody').find_all('tr')
 
-        if locale_content[2].text == 'English':
-            country = locale_content[1].text.lower().replace(' ', '')
-            code = locale_content[0].text
-            locale_code[country] = code
+        locale_code = {}
+        for locale in locale_list_parent:
+            locale_content = locale.find_all('td')
+
+            if locale_content[2].text == 'English':
+                country = locale_content[1].text.lower().replace(' ', '')
+                code = locale_content[0].text
+                locale_code[country] = code
     
-    # Insert data into database
-    sql_statement = '''
-    DROP TABLE IF EXISTS 'Locale'
+        # Update the table in a single transaction, keeping the Id of every
+        # country still on the page since Business.location_country refers to it
+        sql_statement = '''
+        DELETE FROM Locale WHERE Locale.country NOT IN ({})
+        '''.format(', '.join('?' * len(locale_code)))
+        get_cursor().execute(sql_statement, list(locale_code))
+        sql_statement = '''
+        INSERT INTO Locale
+        VALUES (NULL, ?, ?, ?)
+        ON CONFLICT("country") DO UPDATE SET
+        locale_code = excluded.locale_code, alpha2 = excluded.alpha2
+        '''
+        locale_code_insertion = []
+        for key,value in locale_code.items():
+            alpha2 = value.split('_')[1]
+            locale_code_insertion.append([key, value, alpha2])
+        get_cursor().executemany(sql_statement, locale_code_insertion)
+        set_meta('locale_hash', locale_hash)
+        get_connection().commit()
+
+        LOCALE_CODE_DICT = locale_code
+        return locale_code
+    
+def get_categories_signature():
+    ''' Build a signature of categories.json that changes whenever the file does.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    string
+        index version, modification time and size of the file
     '''
-    cur.execute(sql_statement)
+    file_stat = os.stat(CATEGORIES_FILENAME)
+    return '{}:{}:{}'.format(CATEGORY_INDEX_VERSION, file_stat.st_mtime_ns, file_stat.st_size)
 
-    sql_statement = '''
-    CREATE TABLE "Locale" (
-    "Id"	INTEGER,
-    "country"	TEXT,
-    "locale_code"	TEXT,
-    "alpha2"	TEXT,
-    PRIMARY KEY("Id" AUTOINCREMENT)
-    )
+def get_category_ancestors(alias, parents_dict, ancestors_dict):
+    ''' Collect every ancestor of a category in the yelp category tree.
+
+    Parameters
+    ----------
+    alias: string
+        the alias of a category
+
+    parents_dict: dict
+        key is a category alias and value is a list of its parent aliases
+
+    ancestors_dict: dict
+        memo of already resolved categories, key is a category alias and
+        value is a dict of its ancestor aliases and their depth
+
+    Returns
+    -------
+    dict
+        key is an ancestor alias and value is its distance from the category
     '''
-    cur.execute(sql_statement)
-        
-    for key,value in locale_code.items():
-        alpha2 = value.split('_')[1]
+    if alias in ancestors_dict:
+        return ancestors_dict[alias]
+    # guards against cycles in the tree
+    ancestors_dict[alias] = {}
+
+    ancestors = {}
+    for parent in parents_dict.get(alias, []):
+        ancestors[parent] = 1
+        for ancestor, depth in get_category_ancestors(parent, parents_dict, ancestors_dict).items():
+            if depth + 1 < ancestors.get(ancestor, depth + 2):
+                ancestors[ancestor] = depth + 1
+    ancestors_dict[alias] = ancestors
+    return ancestors
+
+def get_category_rows():
+    ''' Get (alias, title) pairs of yelp categories of restaurants.
+
+    The restaurant subset of categories.json, every category below
+    'restaurants' at any depth, is compiled into the Categories table once
+    and loaded from there afterwards, together with the CategoryClosure
+    table of the whole category tree. Both are only compiled again when
+    the file's modification time or size changes.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    category_rows: list
+        a list of (alias, title) tuples
+    '''
+    global CATEGORY_ROWS
+    with CATEGORY_LOCK:
+        if CATEGORY_ROWS is not None:
+            return CATEGORY_ROWS
+
+        categories_signature = get_categories_signature()
+        if get_meta('categories_signature') == categories_signature:
+            sql_statement = '''
+            SELECT Categories.category, Categories.title FROM Categories
+            ORDER BY Categories.Id ASC
+            '''
+            CATEGORY_ROWS = get_cursor().execute(sql_statement).fetchall()
+            return CATEGORY_ROWS
+
+        with open (CATEGORIES_FILENAME, 'r') as load_category_file:
+            load_dict = json.load(load_category_file)
+    
+        parents_dict = {}
+        for item in load_dict:
+            parents_dict[item['alias']] = item.get('parents', [])
+
+        ancestors_dict = {}
+        closure_rows = []
+        category_rows = []
+        rule_rows = []
+        for item in load_dict:
+            for alpha2 in item.get('country_whitelist', []):
+                rule_rows.append((item['alias'], alpha2, 'whitelist'))
+            for alpha2 in item.get('country_blacklist', []):
+                rule_rows.append((item['alias'], alpha2, 'blacklist'))
+            ancestors = get_category_ancestors(item['alias'], parents_dict, ancestors_dict)
+            closure_rows.append((item['alias'], item['alias'], 0))
+            for ancestor, depth in ancestors.items():
+                closure_rows.append((ancestor, item['alias'], depth))
+            if 'restaurants' in ancestors:
+                category_rows.append((item['alias'], item['title']))
+
+        # Rebuild the tables in a single transaction
+        get_cursor().execute('DROP TABLE IF EXISTS "CategoryClosure"')
         sql_statement = '''
-        INSERT OR IGNORE INTO Locale 
-        VALUES (NULL, ?, ?, ?)
+        CREATE TABLE "CategoryClosure" (
+    	"ancestor"	TEXT NOT NULL,
+    	"descendant"	TEXT NOT NULL,
+    	"depth"	INTEGER NOT NULL,
+    	PRIMARY KEY("ancestor", "descendant")
+        ) WITHOUT ROWID;
         '''
-        locale_code_insertion = [key, value, alpha2]
-        cur.execute(sql_statement, locale_code_insertion)
-        conn.commit()
-    return locale_code
-    
-def get_categories_list():
+        get_cursor().execute(sql_statement)
+        get_cursor().execute('CREATE INDEX "CategoryClosure_descendant" ON "CategoryClosure" ("descendant")')
+        get_cursor().executemany('INSERT OR IGNORE INTO CategoryClosure VALUES (?, ?, ?)', closure_rows)
+
+        get_cursor().execute('DROP TABLE IF EXISTS "CategoryCountryRule"')
+        sql_statement = '''
+        CREATE TABLE "CategoryCountryRule" (
+    	"category"	TEXT NOT NULL,
+    	"alpha2"	TEXT NOT NULL,
+    	"rule"	TEXT NOT NULL,
+    	PRIMARY KEY("category", "alpha2", "rule")
+        ) WITHOUT ROWID;
+        '''
+        get_cursor().execute(sql_statement)
+        get_cursor().executemany('INSERT OR IGNORE INTO CategoryCountryRule VALUES (?, ?, ?)', rule_rows)
+
+        get_cursor().execute('DROP TABLE IF EXISTS "Categories"')
+        sql_statement = '''
+        CREATE TABLE "Categories" (
+    	"Id"	INTEGER,
+    	"category"	TEXT,
+    	"title"	TEXT,
+    	PRIMARY KEY("Id" AUTOINCREMENT)
+        );
+        '''
+        get_cursor().execute(sql_statement)
+        sql_statement = '''
+        INSERT OR IGNORE INTO Categories
+        VALUES (NULL, ?, ?)
+        '''
+        get_cursor().executemany(sql_statement, category_rows)
+        set_meta('categories_signature', categories_signature)
+        get_connection().commit()
+
+        CATEGORY_ROWS = category_rows
+        return category_rows
+
+def get_country_category_rows(alpha2):
+    ''' Get (alias, title) pairs of restaurant categories yelp serves in a country.
+
+    The CountryCategories table holds the valid categories of every
+    country in the Locale table, derived from the country_whitelist and
+    country_blacklist of categories.json. It is rebuilt only when either
+    the locale page or categories.json changes.
+
+    Parameters
+    ----------
+    alpha2: string
+        the alpha-2 code of a country (e.g. US)
+
+    Returns
+    -------
+    list
+        a list of (alias, title) tuples
+    '''
+    with CATEGORY_LOCK:
+        if alpha2 in COUNTRY_CATEGORY_ROWS:
+            return COUNTRY_CATEGORY_ROWS[alpha2]
+
+        get_locale_code()
+        get_category_rows()
+        country_categories_signature = get_meta('categories_signature') + '|' + get_meta('locale_hash')
+        if get_meta('country_categories_signature') != country_categories_signature:
+            # Rebuild the table in a single transaction
+            get_cursor().execute('DROP TABLE IF EXISTS "CountryCategories"')
+            sql_statement = '''
+            CREATE TABLE "CountryCategories" (
+            "alpha2"	TEXT NOT NULL,
+            "category_id"	INTEGER NOT NULL,
+            PRIMARY KEY("alpha2", "category_id")
+            ) WITHOUT ROWID
+            '''
+            get_cursor().execute(sql_statement)
+            sql_statement = '''
+            INSERT OR IGNORE INTO CountryCategories
+            SELECT Locale.alpha2, Categories.Id
+            FROM Locale, Categories
+            WHERE NOT EXISTS (
+                SELECT 1 FROM CategoryCountryRule
+                WHERE CategoryCountryRule.category = Categories.category
+                AND CategoryCountryRule.rule = 'blacklist'
+                AND CategoryCountryRule.alpha2 = Locale.alpha2)
+            AND (NOT EXISTS (
+                SELECT 1 FROM CategoryCountryRule
+                WHERE CategoryCountryRule.category = Categories.category
+                AND CategoryCountryRule.rule = 'whitelist')
+            OR EXISTS (
+                SELECT 1 FROM CategoryCountryRule
+                WHERE CategoryCountryRule.category = Categories.category
+                AND CategoryCountryRule.rule = 'whitelist'
+                AND CategoryCountryRule.alpha2 = Locale.alpha2))
+            '''
+            get_cursor().execute(sql_statement)
+            set_meta('country_categories_signature', country_categories_signature)
+            get_connection().commit()
+
+        sql_statement = '''
+        SELECT Categories.category, Categories.title
+        FROM CountryCategories JOIN Categories
+        ON CountryCategories.category_id = Categories.Id
+        WHERE CountryCategories.alpha2 = ?
+        ORDER BY Categories.Id ASC
+        '''
+        COUNTRY_CATEGORY_ROWS[alpha2] = get_cursor().execute(sql_statement, [alpha2]).fetchall()
+        return COUNTRY_CATEGORY_ROWS[alpha2]
+
+def get_categories_list(alpha2=None):
     ''' Get a list of yelp categories of restaurants.
 
     Parameters
     ----------
-    None
+    alpha2: string
+        the alpha-2 code of a country, only categories valid there are
+        returned; None returns every restaurant category
 
     Returns
     -------
     category_list: list
         a list of categories
     '''
-    with open ('categories.json', 'r') as load_category_file:
-        load_dict = json.load(load_category_file)
-    
-    category_list = []
+    if alpha2 is None:
+        return [alias for alias, title in get_category_rows()]
+    return [alias for alias, title in get_country_category_rows(alpha2)]
 
-    sql_statement = '''
-    DROP TABLE IF EXISTS 'Categories'
-    '''
-    cur.execute(sql_statement)
+def get_category_descendants(category, alpha2=None):
+    ''' Expand a category to itself and all of its descendant categories.
+
+    Parameters
+    ----------
+    category: string
+        the alias of a category
 
+    alpha2: string
+        the alpha-2 code of a country, descendants yelp does not serve
+        there are left out; None keeps all of them
+
+    Returns
+    -------
+    list
+        a list of category aliases, the category itself first
+    '''
+    get_category_rows()
     sql_statement = '''
-    CREATE TABLE "Categories" (
-	"Id"	INTEGER,
-	"category"	TEXT,
-	PRIMARY KEY("Id" AUTOINCREMENT)
-    );
+    SELECT CategoryClosure.descendant FROM CategoryClosure
+    WHERE CategoryClosure.ancestor = ?
+    ORDER BY CategoryClosure.depth ASC, CategoryClosure.descendant ASC
     '''
-    cur.execute(sql_statement)
+    descendants = [row[0] for row in get_cursor().execute(sql_statement, [category]).fetchall()]
+    if alpha2 is not None:
+        valid_categories = set(get_categories_list(alpha2))
+        descendants = [alias for alias in descendants if alias == category or alias in valid_categories]
+    if len(descendants) == 0:
+        return [category]
+    return descendants
 
-    for item in load_dict:
-        try:
-            if item['parents'][0] == "restaurants":
-                category_list.append(item['alias'])
-                sql_statement = '''
-                INSERT OR IGNORE INTO Categories
-                VALUES (NULL, ?)
-                '''
-                category_insertion = [item['alias']]
-                cur.execute(sql_statement, category_insertion)
-                conn.commit()
-        except:
-            pass
-    
-    return category_list
+def get_category_index(alpha2=None):
+    ''' Get the fuzzy search index of restaurant categories, built once per process.
+
+    Parameters
+    ----------
+    alpha2: string
+        the alpha-2 code of a country, only categories valid there are
+        indexed; None indexes every restaurant category
+
+    Returns
+    -------
+    CategoryIndex
+        the trigram index over category aliases and titles
+    '''
+    global CATEGORY_INDEX
+    with CATEGORY_LOCK:
+        if alpha2 is not None:
+            if alpha2 not in COUNTRY_CATEGORY_INDEX:
+                COUNTRY_CATEGORY_INDEX[alpha2] = CategoryIndex(get_country_category_rows(alpha2))
+            return COUNTRY_CATEGORY_INDEX[alpha2]
+        if CATEGORY_INDEX is None:
+            CATEGORY_INDEX = CategoryIndex(get_category_rows())
+        return CATEGORY_INDEX
 
 def process_input_country(country):
     ''' Process the user input of a valid country name
@@ -212,24 +813,31 @@ def process_input_country(country):
         country_locale_code = locale_code_dict[country_input]
         url_pieces = 'locale=' + country_locale_code
         sentence_1 = 'You are now searching in ' + country + '. '
-        sentence_2 = 'Please Enter a city (type \'exit\' to quit.) : '
+        sentence_2 = 'Please Enter a city, or several cities separated by commas (type \'exit\' to quit.) : '
         input_query = sentence_1 + sentence_2
         city = input(input_query)
         
         if city == 'exit':
-            quit()
+            exit_program()
+        elif ',' in city:
+            city_list = [city_i.strip() for city_i in city.split(',') if city_i.strip() != '']
+            process_multi_city_input(city_list, url_pieces, country_locale_code.split('_')[1])
+            return
         else:
             city_input = city.lower().replace(' ','')
         
         url_pieces = url_pieces + '&location=' + city_input
-        process_category_input(city, url_pieces)
+        process_category_input(city, url_pieces, country_locale_code.split('_')[1])
 
     else:
         print('Sorry, please input a valid country name.')
     
-def process_category_input(city, url_pieces):
+def process_category_input(city, url_pieces, alpha2):
     ''' Process the user input of a valid category with ability of fuzzy matching
 
+    Only categories yelp serves in the searched country are listed, matched
+    and requested, so invalid combinations never reach the API.
+
     Parameters
     ----------
     city: string
@@ -238,20 +846,44 @@ def process_category_input(city, url_pieces):
     url_pieces: string
         the component of a url which is to be requested upon
     
+    alpha2: string
+        the alpha-2 code of the searched country (e.g. US)
+    
     Returns
     -------
     None
     '''
+    category = choose_category(city, alpha2)
+    category_aliases = get_search_category_aliases(category, alpha2)
+    url_category = get_search_url(url_pieces, category_aliases)
+    process_recommend_input(url_category)
+
+def choose_category(city, alpha2):
+    ''' Prompt the user for a restaurant category valid in a country.
+
+    Parameters
+    ----------
+    city: string
+        user input of a city, shown in the prompt
+    
+    alpha2: string
+        the alpha-2 code of the searched country (e.g. US)
+    
+    Returns
+    -------
+    string
+        the alias of the chosen category
+    '''
     sentence_1 = 'You are now searching in ' + city
     sentence_2 = '. Please choose a restaurant category （type \'list\' to see all valid categories. '
-    sentence_3 = 'type \'exit\' to quit. You can just enter first five letters for fuzzy matches.）: '
+    sentence_3 = 'type \'exit\' to quit. Fuzzy matching is supported, typos are fine.）: '
     input_query = sentence_1 + sentence_2 + sentence_3
-    flag = True
     category = ''
-    category_list = get_categories_list()
+    category_list = get_categories_list(alpha2)
+    category_index = get_category_index(alpha2)
     
     # get category parameter
-    while flag:
+    while category == '':
         category_input = input(input_query).strip().lower()
         
         if category_input == 'list':
@@ -271,36 +903,111 @@ def process_category_input(city, url_pieces):
             continue
         
         if category_input == 'exit':
-            print('Bye. Have a nice day!')
-            quit()
+            exit_program()
         
         # Fuzzy Searching
         if category_input in category_list:
             category = category_input
-            flag = False
-        else:
-            for category_i in category_list:
-                if (category_input in category_i) and len(category_input) >= 5:
-                    flag_2 = True
-                    while flag_2:
-                        response_searching = input('Are you searching for ' + category_i + '? (Y/N) ').lower().strip()
-                        if response_searching == 'y':
-                            category = category_i
-                            flag = False
-                            flag_2 = False
-                        elif response_searching == 'n':
-                            flag_2 = False
-                        else:
-                            print("Invalid input.")
-                    if flag == False:
-                        break
-                    else:
-                        continue
-            if category == '':
-                flag = True
+            continue
+        if category_input in get_categories_list():
+            print('Sorry, ' + category_input + ' is not available in this country.')
+            continue
+
+        matches = category_index.search(category_input)
+        if len(matches) == 0:
+            print('No category matches \'' + category_input + '\'.')
+            continue
+        if matches[0][2].lower() == category_input:
+            category = matches[0][1]
+            continue
+
+        print('Are you searching for:')
+        for match_pos, (score, alias, title) in enumerate(matches, 1):
+            print('[{}] {} ({})'.format(match_pos, alias, title))
+        while True:
+            response_searching = input('Choose a number, or \'n\' to search again: ').lower().strip()
+            if response_searching == 'n':
+                break
+            elif response_searching.isdigit() and 1 <= int(response_searching) <= len(matches):
+                category = matches[int(response_searching) - 1][1]
+                break
+            else:
+                print("Invalid input.")
     
-    url_category = BASE_URL_SEARCH + url_pieces + '&categories=' + category + '&limit=50'
-    process_recommend_input(url_category)
+    return category
+
+def get_search_category_aliases(category, alpha2):
+    ''' Expand a chosen category to the aliases one search request covers.
+
+    Parameters
+    ----------
+    category: string
+        the alias of the chosen category
+    
+    alpha2: string
+        the alpha-2 code of the searched country (e.g. US)
+    
+    Returns
+    -------
+    list
+        the category and its subcategories valid in the country
+    '''
+    # one request covers the category and all of its subcategories
+    category_aliases = get_category_descendants(category, alpha2)
+    if len(category_aliases) > 1:
+        print('Searching ' + category + ' and ' + str(len(category_aliases) - 1) + ' subcategories.')
+    return category_aliases
+
+def get_search_url(url_pieces, category_aliases):
+    ''' Build the url of the first page of a search.
+
+    Parameters
+    ----------
+    url_pieces: string
+        the locale and location component of the url
+    
+    category_aliases: list
+        the aliases of the searched categories
+    
+    Returns
+    -------
+    string
+        the url to be requested upon
+    '''
+    return BASE_URL_SEARCH + url_pieces + '&categories=' + ','.join(category_aliases) + '&limit=' + str(SEARCH_PAGE_SIZE)
+
+def process_multi_city_input(city_list, url_pieces, alpha2):
+    ''' Search one category in several cities at once and print the best
+    restaurants across all of them.
+
+    Parameters
+    ----------
+    city_list: list
+        user input of several cities
+    
+    url_pieces: string
+        the locale component of a url which is to be requested upon
+    
+    alpha2: string
+        the alpha-2 code of the searched country (e.g. US)
+    
+    Returns
+    -------
+    None
+    '''
+    category = choose_category(', '.join(city_list), alpha2)
+    category_aliases = get_search_category_aliases(category, alpha2)
+    url_dict = {}
+    for city in city_list:
+        city_url_pieces = url_pieces + '&location=' + city.lower().replace(' ','')
+        url_dict[city] = get_search_url(city_url_pieces, category_aliases)
+
+    care_weight_dict = dict(zip(choose_care_list(), CARE_WEIGHTS))
+    ranking = search_multiple_cities(url_dict, care_weight_dict)
+    if len(ranking) == 0:
+        print('No such category of restaurants in these cities.')
+    else:
+        print_multi_city_recommendations(ranking)
 
 def process_recommend_input(url_category):
     ''' Process user input of care level.
@@ -314,7 +1021,10 @@ def process_recommend_input(url_category):
     -------
     None
     '''
-    business_instance_list = get_business_instance_list(url_category)
+    global ACTIVE_WORKING_SET
+    working_set = load_working_set(url_category)
+    ACTIVE_WORKING_SET = working_set
+    business_instance_list = working_set.business_instance_list
     
     if len(business_instance_list) == 0:
         print('No such category of restaurants here.')
@@ -328,59 +1038,76 @@ def process_recommend_input(url_category):
         print(str(len(business_instance_list)) + ' restaurants match')
         print()
 
-        while True:
-            care_most_res = input('What do you care MOST when making your choice? \na. Price  b. Rating  c. Review count\n' + 
-                '(Due to the limitation of the data source, you may type \'c\' here for best visualization): ').strip().lower()
-            print()
-            if care_most_res == 'a':
-                care_most = 'price_level'
-                break
-            elif care_most_res == 'b':
-                care_most = 'rating'
-                break
-            elif care_most_res == 'c':
-                care_most = 'review_count'
-                break
-            elif care_most_res == 'exit':
-                quit()
-            else:
-                print('Invalid Input.')
-        
-        while True:
-            care_least_res = input('What do you care LEAST when making your choice? \na. Price  b. Rating  c. Review count\n: ').strip().lower()
-            print()
-            if care_least_res == care_most_res:
-                print('Your care least option can not be the same with care most option.')
-                continue
-            if care_least_res == 'a':
-                care_least = 'price_level'
-                break
-            elif care_least_res == 'b':
-                care_least = 'rating'
-                break
-            elif care_least_res == 'c':
-                care_least = 'review_count'
-                break
-            elif care_least_res == 'exit':
-                quit()
-            else:
-                print('Invalid Input.')
-        
-        # determine the care list
-        care_list_origin = ['price_level', 'rating', 'review_count']
-        care_list = []
-        care_list.append(care_most)
-        care_list.append(care_least)
-        for care in care_list_origin:
-            if care not in care_list:
-                care_list.append(care)
-        care_tmp = care_list[1]
-        care_list[1] = care_list[2]
-        care_list[2] = care_tmp
-
-        process_recommend_care_list(care_list)
-
-def process_recommend_care_list(care_list):
+        care_list = choose_care_list()
+        process_recommend_care_list(care_list, working_set)
+    working_set.flush()
+    ACTIVE_WORKING_SET = None
+
+def choose_care_list():
+    ''' Prompt the user for the criteria cared about most and least.
+
+    Parameters
+    ----------
+    None
+    
+    Returns
+    -------
+    care_list: list
+        the care columns from most to least important
+    '''
+    while True:
+        care_most_res = input('What do you care MOST when making your choice? \na. Price  b. Rating  c. Review count\n' + 
+            '(Due to the limitation of the data source, you may type \'c\' here for best visualization): ').strip().lower()
+        print()
+        if care_most_res == 'a':
+            care_most = 'price_level'
+            break
+        elif care_most_res == 'b':
+            care_most = 'rating'
+            break
+        elif care_most_res == 'c':
+            care_most = 'review_count'
+            break
+        elif care_most_res == 'exit':
+            exit_program()
+        else:
+            print('Invalid Input.')
+    
+    while True:
+        care_least_res = input('What do you care LEAST when making your choice? \na. Price  b. Rating  c. Review count\n: ').strip().lower()
+        print()
+        if care_least_res == care_most_res:
+            print('Your care least option can not be the same with care most option.')
+            continue
+        if care_least_res == 'a':
+            care_least = 'price_level'
+            break
+        elif care_least_res == 'b':
+            care_least = 'rating'
+            break
+        elif care_least_res == 'c':
+            care_least = 'review_count'
+            break
+        elif care_least_res == 'exit':
+            exit_program()
+        else:
+            print('Invalid Input.')
+    
+    # determine the care list
+    care_list_origin = ['price_level', 'rating', 'review_count']
+    care_list = []
+    care_list.append(care_most)
+    care_list.append(care_least)
+    for care in care_list_origin:
+        if care not in care_list:
+            care_list.append(care)
+    care_tmp = care_list[1]
+    care_list[1] = care_list[2]
+    care_list[2] = care_tmp
+
+    return care_list
+
+def process_recommend_care_list(care_list, working_set):
     ''' Process user input of care level and calculate the recommendation score.
 
     Parameters
@@ -388,52 +1115,714 @@ def process_recommend_care_list(care_list):
     care_list: list
         a list of user's care level according to the items' rank
     
+    working_set: WorkingSet
+        the scored search
+    
+    Returns
+    -------
+    None
+    '''
+    care_weight_dict = dict(zip(care_list, CARE_WEIGHTS))
+
+    working_set.score(care_weight_dict)
+    
+    visualize_recommendation(care_weight_dict, working_set)
+
+class TopKHeap:
+    '''a max-heap of scores that answers k-best queries and accepts updates
+    without re-sorting; replaced entries are dropped lazily
+
+    Instance Attributes
+    -------------------
+    scores: dict
+        key is a business id and value is its current score
+
+    heap: list
+        (negative score, business id) entries, possibly stale
+    '''
+    def __init__(self, scores):
+        self.scores = dict(scores)
+        self.rebuild()
+
+    def rebuild(self):
+        ''' Heapify the current scores, dropping all stale entries.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        None
+        '''
+        self.heap = [(-score, business_id) for business_id, score in self.scores.items()]
+        heapq.heapify(self.heap)
+
+    def update(self, business_id, score):
+        ''' Insert a business or change its score.
+
+        Parameters
+        ----------
+        business_id: integer
+            the Id of the business in Business
+
+        score: float
+            the new score of the business
+
+        Returns
+        -------
+        None
+        '''
+        self.scores[business_id] = score
+        heapq.heappush(self.heap, (-score, business_id))
+        self.compact()
+
+    def remove(self, business_id):
+        ''' Remove a business.
+
+        Parameters
+        ----------
+        business_id: integer
+            the Id of the business in Business
+
+        Returns
+        -------
+        None
+        '''
+        self.scores.pop(business_id, None)
+        self.compact()
+
+    def compact(self):
+        ''' Rebuild the heap once stale entries outnumber live ones.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        None
+        '''
+        if len(self.heap) > 2 * len(self.scores) + 64:
+            self.rebuild()
+
+    def top(self, k):
+        ''' Get the k best businesses in O(k log n).
+
+        Parameters
+        ----------
+        k: integer
+            the number of businesses returned
+
+        Returns
+        -------
+        list
+            a list of (business id, score) tuples, best first
+        '''
+        top_list = []
+        kept = []
+        seen = set()
+        while len(self.heap) > 0 and len(top_list) < k:
+            entry = heapq.heappop(self.heap)
+            business_id = entry[1]
+            if business_id in seen or self.scores.get(business_id) != -entry[0]:
+                continue
+            seen.add(business_id)
+            kept.append(entry)
+            top_list.append((business_id, -entry[0]))
+        for entry in kept:
+            heapq.heappush(self.heap, entry)
+        return top_list
+
+    def __len__(self):
+        return len(self.scores)
+
+class ScoreMatrix:
+    '''the normalized features of a search and its scores under every weight profile
+
+    Instance Attributes
+    -------------------
+    business_ids: list
+        the Business ids of the search in rank order
+
+    raw_features: dict
+        key is a business id and value is its (price level, rating,
+        review count) tuple
+
+    maxima: tuple
+        the maximum price level (ignoring 6), rating and review count
+        used for normalization
+
+    maxima_counts: list
+        the number of rows holding each maximum
+
+    features: dict
+        key is a business id and value is its (price, rating, review count)
+        tuple normalized by the maxima; a lower price level scores higher
+
+    profile_scores: dict
+        key is a weight tuple in CARE_COLUMNS order and value is a dict of
+        business ids and their scores under it
+
+    heaps: dict
+        key is a weight tuple and value is the TopKHeap of its scores,
+        built on the first k-best query
+
+    lock: RLock
+        serializes the threads reading and updating the matrix
+    '''
+    def __init__(self, rows):
+        self.lock = threading.RLock()
+        self.business_ids = [row[0] for row in rows]
+        self.raw_features = {row[0]: tuple(row[1:4]) for row in rows}
+        self.profile_scores = {}
+        self.heaps = {}
+        self.rebuild()
+
+    def rebuild(self):
+        ''' Normalize every row again and rescore every known weight profile.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        None
+        '''
+        self.maxima, self.maxima_counts = self.get_maxima()
+        self.features = {
+            business_id: self.normalize(raw)
+            for business_id, raw in self.raw_features.items()}
+        known_profiles = set(self.profile_scores) | set(get_weight_profiles())
+        self.profile_scores = {}
+        self.score_profiles(known_profiles)
+        for weights in self.heaps:
+            self.heaps[weights] = TopKHeap(self.profile_scores[weights])
+
+    def get_maxima(self):
+        ''' Compute the normalization maxima over all rows.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        tuple
+            the maximum price level (ignoring 6), rating and review count,
+            1 where there is no positive value
+
+        list
+            the number of rows holding each maximum
+        '''
+        maxima = []
+        maxima_counts = []
+        for pos in range(3):
+            values = [raw[pos] for raw in self.raw_features.values() if counts_toward_maximum(pos, raw[pos])]
+            maximum = max(values, default=0) or 1
+            maxima.append(maximum)
+            maxima_counts.append(values.count(maximum))
+        return tuple(maxima), maxima_counts
+
+    def normalize(self, raw):
+        ''' Normalize a (price level, rating, review count) tuple.
+
+        Parameters
+        ----------
+        raw: tuple
+            the raw features of a business
+
+        Returns
+        -------
+        tuple
+            the normalized features of the business
+        '''
+        return (1 - raw[0] / self.maxima[0], raw[1] / self.maxima[1], raw[2] / self.maxima[2])
+
+    def score_profiles(self, weight_vectors):
+        ''' Score every business under several weight vectors at once, as
+        the product of the feature matrix and the weight matrix.
+
+        Parameters
+        ----------
+        weight_vectors: list
+            a list of weight tuples in CARE_COLUMNS order
+
+        Returns
+        -------
+        list
+            one dict of business ids and scores per weight vector
+        '''
+        with self.lock:
+            weight_vectors = [tuple(weights) for weights in weight_vectors]
+            missing = [weights for weights in set(weight_vectors) if weights not in self.profile_scores]
+            if len(missing) > 0:
+                for weights in missing:
+                    self.profile_scores[weights] = {}
+                for business_id, (price, rating, review) in self.features.items():
+                    for w_price, w_rating, w_review in missing:
+                        self.profile_scores[(w_price, w_rating, w_review)][business_id] = \
+                            price * w_price + rating * w_rating + review * w_review
+            return [self.profile_scores[weights] for weights in weight_vectors]
+
+    def rank(self, weights, k=None):
+        ''' Rank the businesses of the search under a weight vector.
+
+        Parameters
+        ----------
+        weights: tuple
+            weights in CARE_COLUMNS order, or a dict keyed by care column
+
+        k: integer
+            the number of businesses returned, None returns all of them
+
+        Returns
+        -------
+        list
+            a list of (business id, score) tuples, best first
+        '''
+        with self.lock:
+            if isinstance(weights, dict):
+                weights = tuple(weights[column] for column in CARE_COLUMNS)
+            if k is not None:
+                return self.top(weights, k)
+            scores = self.score_profiles([weights])[0]
+            return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+    def top(self, weights, k):
+        ''' Get the k best businesses under a weight vector from its heap.
+
+        Parameters
+        ----------
+        weights: tuple
+            weights in CARE_COLUMNS order
+
+        k: integer
+            the number of businesses returned
+
+        Returns
+        -------
+        list
+            a list of (business id, score) tuples, best first
+        '''
+        with self.lock:
+            weights = tuple(weights)
+            if weights not in self.heaps:
+                self.heaps[weights] = TopKHeap(self.score_profiles([weights])[0])
+            return self.heaps[weights].top(k)
+
+    def rank_uncached(self, weights, k):
+        ''' Get the k best businesses under a weight vector without keeping
+        its scores, for one-off weights that should not grow the matrix.
+
+        Parameters
+        ----------
+        weights: tuple
+            weights in CARE_COLUMNS order
+
+        k: integer
+            the number of businesses returned
+
+        Returns
+        -------
+        list
+            a list of (business id, score) tuples, best first
+        '''
+        with self.lock:
+            scores = [
+                (business_id, sum(feature * weight for feature, weight in zip(features, weights)))
+                for business_id, features in self.features.items()]
+        return heapq.nlargest(k, scores, key=lambda item: item[1])
+
+    def upsert_business(self, business_id, price_level, rating, review_count):
+        ''' Insert a business or change its features, rescoring only that
+        business unless the normalization maxima move.
+
+        Parameters
+        ----------
+        business_id: integer
+            the Id of the business in Business
+
+        price_level, rating, review_count: number
+            the raw features of the business
+
+        Returns
+        -------
+        None
+        '''
+        with self.lock:
+            old_raw = self.raw_features.get(business_id)
+            new_raw = (price_level, rating, review_count)
+            if old_raw == new_raw:
+                return
+            if old_raw is None:
+                self.business_ids.append(business_id)
+            self.raw_features[business_id] = new_raw
+            if self.maxima_changed(old_raw, new_raw):
+                self.rebuild()
+                return
+
+            features = self.normalize(new_raw)
+            self.features[business_id] = features
+            for weights, scores in self.profile_scores.items():
+                score = sum(feature * weight for feature, weight in zip(features, weights))
+                scores[business_id] = score
+                if weights in self.heaps:
+                    self.heaps[weights].update(business_id, score)
+
+    def remove_business(self, business_id):
+        ''' Remove a business from the search.
+
+        Parameters
+        ----------
+        business_id: integer
+            the Id of the business in Business
+
+        Returns
+        -------
+        None
+        '''
+        with self.lock:
+            old_raw = self.raw_features.pop(business_id, None)
+            if old_raw is None:
+                return
+            self.business_ids.remove(business_id)
+            if self.maxima_changed(old_raw, None):
+                self.features.pop(business_id, None)
+                self.rebuild()
+                return
+
+            self.features.pop(business_id, None)
+            for weights, scores in self.profile_scores.items():
+                scores.pop(business_id, None)
+                if weights in self.heaps:
+                    self.heaps[weights].remove(business_id)
+
+    def maxima_changed(self, old_raw, new_raw):
+        ''' Check whether replacing a row moves any normalization maximum,
+        scanning all rows only when the replaced row was the last one
+        holding a maximum.
+
+        Parameters
+        ----------
+        old_raw: tuple
+            the previous raw features, None for an insert
+
+        new_raw: tuple
+            the new raw features, None for a removal
+
+        Returns
+        -------
+        boolean
+            True if the maxima differ from the stored ones
+        '''
+        rescan = False
+        for pos in range(3):
+            if new_raw is not None and counts_toward_maximum(pos, new_raw[pos]):
+                if new_raw[pos] > self.maxima[pos]:
+                    return True
+                if new_raw[pos] == self.maxima[pos]:
+                    self.maxima_counts[pos] += 1
+            if old_raw is not None and counts_toward_maximum(pos, old_raw[pos]) and old_raw[pos] == self.maxima[pos]:
+                self.maxima_counts[pos] -= 1
+                if self.maxima_counts[pos] == 0:
+                    rescan = True
+        if rescan:
+            maxima, maxima_counts = self.get_maxima()
+            if maxima != self.maxima:
+                return True
+            self.maxima_counts = maxima_counts
+        return False
+
+    def sync(self, rows):
+        ''' Bring the matrix in line with fresh rows of the search, touching
+        only businesses that were added, changed or dropped.
+
+        Parameters
+        ----------
+        rows: list
+            (business id, price level, rating, review count) rows in rank order
+
+        Returns
+        -------
+        None
+        '''
+        with self.lock:
+            new_ids = set(row[0] for row in rows)
+            for business_id in [business_id for business_id in self.business_ids if business_id not in new_ids]:
+                self.remove_business(business_id)
+            for row in rows:
+                self.upsert_business(*row)
+            self.business_ids = [row[0] for row in rows]
+
+def counts_toward_maximum(pos, value):
+    ''' Tell whether a raw feature takes part in its normalization maximum;
+    price level 6 means no price and is ignored.
+
+    Parameters
+    ----------
+    pos: integer
+        the position of the feature in CARE_COLUMNS
+
+    value: number
+        the raw value of the feature
+
     Returns
     -------
+    boolean
+        True if the value counts toward the maximum
+    '''
+    return not (pos == 0 and value == 6)
+
+def get_weight_profiles():
+    ''' List the weight vectors of every care_most/care_least ordering.
+
+    Parameters
+    ----------
     None
+
+    Returns
+    -------
+    list
+        a list of weight tuples in CARE_COLUMNS order
     '''
-    care_weight_dict = {}
-    care_weight_dict[care_list[0]] = 0.6
-    care_weight_dict[care_list[1]] = 0.3
-    care_weight_dict[care_list[2]] = 0.1
+    weight_profiles = []
+    for care_list in itertools.permutations(CARE_COLUMNS):
+        care_weight_dict = dict(zip(care_list, CARE_WEIGHTS))
+        weight_profiles.append(tuple(care_weight_dict[column] for column in CARE_COLUMNS))
+    return weight_profiles
+
+def get_score_rows(search_id):
+    ''' Read the raw scoring features of a search.
 
+    Parameters
+    ----------
+    search_id: integer
+        the Id of the search in Search
+
+    Returns
+    -------
+    list
+        (business id, price level, rating, review count) rows in rank order
+    '''
     sql_statement = '''
-        SELECT Business.review_count, Business.rating, Business.price_level
-        FROM Business
-        ORDER BY Business.Id ASC
-    '''
-    response_raw_data = cur.execute(sql_statement).fetchall()
-
-    review_count_list = []
-    rating_list = []
-    price_level_list = []
-    for response in response_raw_data:
-        review_count_list.append(response[0])
-        rating_list.append(response[1])
-        if response[2] != 6:
-            price_level_list.append(response[2])
-    review_count_max = max(review_count_list)
-    rating_max = max(rating_list)
-    price_level_max = max(price_level_list)
-
-    for response in response_raw_data:
-        recommendation_score = \
-            (response[0] / review_count_max) * care_weight_dict['review_count'] + \
-            (response[1] / rating_max) * care_weight_dict['rating'] + \
-            (1 - (response[2] /  price_level_max)) * care_weight_dict['price_level']
-        business_id = response_raw_data.index(response) + 1
-        sql_statement_recommendation_score = '''
-            UPDATE Business
-            SET recommendation_score = ?
-            WHERE Business.Id = ?
-        '''
-        sql_statement_recommendation_score_update = [recommendation_score, business_id]
-        cur.execute(sql_statement_recommendation_score, sql_statement_recommendation_score_update)
-        conn.commit()
-    
-    visualize_recommendation(care_weight_dict)
-
-def visualize_recommendation(care_weight_dict):
+        SELECT Business.id, Business.price_level, Business.rating, Business.review_count
+        FROM SearchResult JOIN Business ON SearchResult.business_id = Business.id
+        WHERE SearchResult.search_id = ?
+        ORDER BY SearchResult.rank ASC
+    '''
+    return get_cursor().execute(sql_statement, [search_id]).fetchall()
+
+def get_top_recommendations(search_id, care_weight_dict, k=TOP_RECOMMENDATION_COUNT):
+    ''' Get the k best businesses of a search under a weight profile.
+
+    Parameters
+    ----------
+    search_id: integer
+        the Id of the search in Search
+
+    care_weight_dict: dict
+        a dictionary of care level and weight, any weights are accepted
+
+    k: integer
+        the number of businesses returned
+
+    Returns
+    -------
+    list
+        a list of (business id, score) tuples, best first
+    '''
+    return get_score_matrix(search_id).rank(care_weight_dict, k)
+
+def get_score_matrix(search_id):
+    ''' Get the score matrix of a search, built once and kept in memory.
+
+    Parameters
+    ----------
+    search_id: integer
+        the Id of the search in Search
+
+    Returns
+    -------
+    ScoreMatrix
+        the scores of the search under every weight profile
+    '''
+    with SCORE_MATRIX_LOCK:
+        if search_id in SCORE_MATRIX_CACHE:
+            SCORE_MATRIX_CACHE.move_to_end(search_id)
+            return SCORE_MATRIX_CACHE[search_id]
+
+        score_matrix = ScoreMatrix(get_score_rows(search_id))
+        SCORE_MATRIX_CACHE[search_id] = score_matrix
+        if len(SCORE_MATRIX_CACHE) > SCORE_MATRIX_CACHE_SIZE:
+            SCORE_MATRIX_CACHE.popitem(last=False)
+        return score_matrix
+
+class WorkingSet:
+    '''the businesses of the active search held column by column in memory,
+    so scoring and every chart run without touching the disk; the local
+    store is only written by flush
+
+    Instance Attributes
+    -------------------
+    url_category: string
+        the url of the search
+
+    business_instance_list: list
+        the business instances of the search in rank order
+
+    columns: dict
+        key is a column name and value is the list of its values, one per
+        business in rank order
+
+    score_matrix: ScoreMatrix
+        the scores of the search, keyed by the position of a business
+
+    search_id: integer
+        the Id of the search in Search, None until it is stored
+
+    dirty: boolean
+        True while the businesses are not in the local store yet
+
+    scored: boolean
+        True once recommendation_score holds scores to flush
+    '''
+    def __init__(self, url_category, business_instance_list, search_id=None):
+        self.url_category = url_category
+        self.business_instance_list = business_instance_list
+        self.search_id = search_id
+        self.dirty = search_id is None
+        self.scored = False
+        self.columns = {
+            'name': [instance.name for instance in business_instance_list],
+            'review_count': [instance.review_count for instance in business_instance_list],
+            'rating': [instance.rating for instance in business_instance_list],
+            'price_level': [instance.price_level for instance in business_instance_list],
+            'location_city': [instance.location_city for instance in business_instance_list],
+            'location_display_address': [get_display_address(instance) for instance in business_instance_list],
+            'display_phone': [instance.display_phone for instance in business_instance_list],
+            'recommendation_score': [0.0] * len(business_instance_list),
+        }
+        self.score_matrix = ScoreMatrix(list(zip(range(len(business_instance_list)),
+            self.columns['price_level'], self.columns['rating'], self.columns['review_count'])))
+
+    def score(self, care_weight_dict):
+        ''' Fill recommendation_score with the scores under a weight profile.
+
+        Parameters
+        ----------
+        care_weight_dict: dict
+            a dictionary of user's care level and weight
+
+        Returns
+        -------
+        None
+        '''
+        weights = tuple(care_weight_dict[column] for column in CARE_COLUMNS)
+        scores = self.score_matrix.score_profiles([weights])[0]
+        self.columns['recommendation_score'] = [scores[pos] for pos in range(len(self.business_instance_list))]
+        self.scored = True
+
+    def get_rows(self, column_list, order_by=None, skip_no_price=False):
+        ''' Read rows of the working set the way the chart queries read
+        the local store.
+
+        Parameters
+        ----------
+        column_list: list
+            the names of the selected columns
+
+        order_by: string
+            a column to sort by in descending order, None keeps rank order
+
+        skip_no_price: boolean
+            True drops the businesses without a price (price level 6)
+
+        Returns
+        -------
+        list
+            a list of tuples of the selected columns
+        '''
+        for column in column_list + ([order_by] if order_by is not None else []):
+            if column not in self.columns:
+                raise ValueError('column ' + repr(column) + ' can not be selected')
+        positions = range(len(self.business_instance_list))
+        if skip_no_price:
+            positions = [pos for pos in positions if self.columns['price_level'][pos] != 6]
+        if order_by is not None:
+            positions = sorted(positions, key=lambda pos: self.columns[order_by][pos], reverse=True)
+        return [tuple(self.columns[column][pos] for column in column_list) for pos in positions]
+
+    def flush(self):
+        ''' Write the working set to the local store in one batch: a search
+        that was fetched this session is stored together with its scores,
+        a stored search only gets its scores updated.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        None
+        '''
+        if len(self.business_instance_list) == 0 or not (self.dirty or self.scored):
+            return
+        if self.dirty:
+            store_business_instance_list(self.business_instance_list, self.url_category,
+                score_list=self.columns['recommendation_score'])
+            self.search_id = get_search_id(self.url_category)
+            self.dirty = False
+        else:
+            sql_statement = '''
+                UPDATE SearchResult
+                SET recommendation_score = ?
+                WHERE SearchResult.search_id = ? AND SearchResult.business_id =
+                    (SELECT Business.id FROM Business WHERE Business.yelp_id = ?)
+            '''
+            get_cursor().executemany(sql_statement, [[score, self.search_id, instance.id]
+                for instance, score in zip(self.business_instance_list, self.columns['recommendation_score'])])
+            get_connection().commit()
+        self.scored = False
+
+def load_working_set(url_category):
+    ''' Load a search into a WorkingSet, from the local store when it holds
+    a fresh copy and from the cache or yelp otherwise, without storing it.
+
+    Parameters
+    ----------
+    url_category: string
+        the url of the search
+
+    Returns
+    -------
+    WorkingSet
+        the working set of the search
+    '''
+    search_id = get_search_id(url_category)
+    if search_id is not None:
+        return WorkingSet(url_category, get_stored_business_instance_list(search_id), search_id)
+    return WorkingSet(url_category, get_business_instance_list(url_category, store=False))
+
+def exit_program():
+    ''' Flush the active working set, if any, and quit. Every 'exit' typed
+    at a prompt goes through here so no scored search is lost.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
+    '''
+    if ACTIVE_WORKING_SET is not None:
+        ACTIVE_WORKING_SET.flush()
+    print('Bye. Have a nice day!')
+    quit()
+
+def visualize_recommendation(care_weight_dict, working_set):
     ''' Process user input of visualization command.
 
     Parameters
@@ -441,6 +1830,9 @@ def visualize_recommendation(care_weight_dict):
     care_weight_dict: dict
         a dictionary of user's care level and weight
 
+    working_set: WorkingSet
+        the visualized search
+
     Returns
     -------
     None
@@ -452,25 +1844,24 @@ def visualize_recommendation(care_weight_dict):
         if vis_response == 'back':
             pass
         elif vis_response == 'exit':
-            print('Bye. Have a nice day!')
-            quit()
+            exit_program()
         elif vis_response == 'help':
             with open('FinalProjVisualizationHelp.txt') as f:
                 print(f.read())
         else:
             vis_res_list = vis_response.split()
             if vis_res_list[0] == 'bar':
-                process_bar_chart(vis_res_list)
+                process_bar_chart(vis_res_list, working_set)
             elif vis_res_list[0] == 'scatter':
-                process_scatter_chart(vis_res_list, care_weight_dict)
+                process_scatter_chart(vis_res_list, care_weight_dict, working_set)
             elif vis_res_list[0] == 'pie':
-                process_pie_chart(vis_res_list)
+                process_pie_chart(vis_res_list, working_set)
             elif vis_res_list[0] == 'bubble':
-                process_bubble_chart(vis_res_list, care_weight_dict)
+                process_bubble_chart(vis_res_list, care_weight_dict, working_set)
             else:
                 print('Invalid Input.')        
 
-def process_bar_chart(vis_res_list):
+def process_bar_chart(vis_res_list, working_set):
     ''' Visualizing data in bar chart and print recommendation info.
     
     Parameters
@@ -478,10 +1869,14 @@ def process_bar_chart(vis_res_list):
     vis_res_list: list
         a list of words in user's input command
     
+    working_set: WorkingSet
+        the visualized search
+    
     Returns
     -------
     None
     '''
+    import plotly.graph_objs as go
     while True:
         list_loc = 0
         if len(vis_res_list) != 2 and len(vis_res_list) != 1:
@@ -504,26 +1899,19 @@ def process_bar_chart(vis_res_list):
             sql_selection = 'recommendation_score'
             list_loc = 4
         
-        sql_statement_bar = '''
-            SELECT Business.name, Business.review_count, Business.rating, 
-            Business.price_level, Business.recommendation_score, 
-            Business.location_display_address, Business.display_phone
-            FROM Business
-            WHERE NOT Business.price_level=6
-            ORDER BY {} DESC
-        '''.format(sql_selection)
-
-        result_list = cur.execute(sql_statement_bar).fetchall()
+        result_list = working_set.get_rows(['name', 'review_count', 'rating', 'price_level',
+            'recommendation_score', 'location_display_address', 'display_phone'],
+            order_by=sql_selection, skip_no_price=True)
 
         # Bar plot
         result_x_axis = []
         result_y_axis = []
         result_info = []
-        for result in result_list:
+        for result_pos, result in enumerate(result_list):
             result_x_axis.append(result[0])
             result_y_axis.append(result[list_loc])
-            if result_list.index(result) <= 6:
-                info_str = '[' + str(result_list.index(result) + 1) + '] ' + result[0] + ', recommendation score is {rs:0.3f}'.format(rs=result[4])
+            if result_pos < TOP_RECOMMENDATION_COUNT:
+                info_str = '[' + str(result_pos + 1) + '] ' + result[0] + ', recommendation score is {rs:0.3f}'.format(rs=result[4])
                 info_str += ', with review_count=' + str(result[1]) + ', price_level=' + str(result[3])
                 info_str += ', rating=' + str(result[2]) +'. Address: ' + result[5] + '. Phone: ' + result[6] 
                 result_info.append(info_str)
@@ -541,7 +1929,7 @@ def process_bar_chart(vis_res_list):
         print('*' * len(result_info[-1]))
         break
 
-def process_scatter_chart(vis_res_list, care_weight_dict):
+def process_scatter_chart(vis_res_list, care_weight_dict, working_set):
     ''' Visualizing data in scatter chart and print recommendation info.
     
     Parameters
@@ -549,10 +1937,17 @@ def process_scatter_chart(vis_res_list, care_weight_dict):
     vis_res_list: list
         a list of words in user's input command
     
+    care_weight_dict: dict
+        a dictionary of user's care level and weight
+    
+    working_set: WorkingSet
+        the visualized search
+    
     Returns
     -------
     None
     '''
+    import plotly.graph_objs as go
     while True:
         scatter_flag_2d = False
         scatter_flag_3d = False
@@ -578,15 +1973,8 @@ def process_scatter_chart(vis_res_list, care_weight_dict):
                 if value == 0.3:
                     y_axis_lable = key
             
-            sql_statement_scatter = '''
-                SELECT Business.name, Business.{}, Business.{}, 
-                Business.recommendation_score, 
-                Business.location_display_address, 
-                Business.display_phone
-                FROM Business
-                ORDER BY Business.recommendation_score DESC
-            '''.format(x_axis_lable, y_axis_lable)
-            result_list = cur.execute(sql_statement_scatter).fetchall()
+            result_list = working_set.get_rows(['name', x_axis_lable, y_axis_lable,
+                'recommendation_score', 'location_display_address', 'display_phone'])
             
             # 2d scatter plot
             result_x_axis = []
@@ -597,11 +1985,11 @@ def process_scatter_chart(vis_res_list, care_weight_dict):
                 result_x_axis.append(result[1])
                 result_y_axis.append(result[2])
                 hover_text.append(result[0] + '<br>recom_score={rs:0.3f}'.format(rs=result[3]))
-                if result_list.index(result) <= 6:
-                    info_str = '[' + str(result_list.index(result) + 1) + '] ' + result[0] + ', recommendation score is {rs:0.3f}'.format(rs=result[3])
-                    info_str += ', with {}='.format(x_axis_lable) + str(result[1]) + ', {}='.format(y_axis_lable) + str(result[2])
-                    info_str += '. Address: ' + result[4] + '. Phone: ' + result[5] 
-                    result_info.append(info_str)
+            for result_pos, result in enumerate(get_top_results(result_list, 3)):
+                info_str = '[' + str(result_pos + 1) + '] ' + result[0] + ', recommendation score is {rs:0.3f}'.format(rs=result[3])
+                info_str += ', with {}='.format(x_axis_lable) + str(result[1]) + ', {}='.format(y_axis_lable) + str(result[2])
+                info_str += '. Address: ' + result[4] + '. Phone: ' + result[5] 
+                result_info.append(info_str)
             scatter_data = go.Scatter(
                 x=result_x_axis, 
                 y=result_y_axis, 
@@ -630,16 +2018,8 @@ def process_scatter_chart(vis_res_list, care_weight_dict):
                     y_axis_lable = key
                 if value == 0.1:
                     z_axis_lable = key
-            sql_statement_scatter = '''
-                SELECT Business.name, 
-                Business.{}, Business.{}, Business.{}, 
-                Business.recommendation_score, 
-                Business.location_display_address, 
-                Business.display_phone
-                FROM Business
-                ORDER BY Business.recommendation_score DESC
-            '''.format(x_axis_lable, y_axis_lable, z_axis_lable)
-            result_list = cur.execute(sql_statement_scatter).fetchall()
+            result_list = working_set.get_rows(['name', x_axis_lable, y_axis_lable, z_axis_lable,
+                'recommendation_score', 'location_display_address', 'display_phone'])
 
             # 3d scatter plot
             result_x_axis = []
@@ -652,11 +2032,11 @@ def process_scatter_chart(vis_res_list, care_weight_dict):
                 result_y_axis.append(result[2])
                 result_z_axis.append(result[3])
                 hover_text.append('<br>' + result[0] + '<br>recom_score={rs:0.3f}'.format(rs=result[4]))
-                if result_list.index(result) <= 6:
-                    info_str = '[' + str(result_list.index(result) + 1) + '] ' + result[0] + ', recommendation score is {rs:0.3f}'.format(rs=result[4])
-                    info_str += ', with {}='.format(x_axis_lable) + str(result[1]) + ', {}='.format(y_axis_lable) + str(result[2])
-                    info_str += ', {}='.format(z_axis_lable) + str(result[3]) +'. Address: ' + result[5] + '. Phone: ' + result[6] 
-                    result_info.append(info_str)
+            for result_pos, result in enumerate(get_top_results(result_list, 4)):
+                info_str = '[' + str(result_pos + 1) + '] ' + result[0] + ', recommendation score is {rs:0.3f}'.format(rs=result[4])
+                info_str += ', with {}='.format(x_axis_lable) + str(result[1]) + ', {}='.format(y_axis_lable) + str(result[2])
+                info_str += ', {}='.format(z_axis_lable) + str(result[3]) +'. Address: ' + result[5] + '. Phone: ' + result[6] 
+                result_info.append(info_str)
             scatter_data_3d = go.Scatter3d(
                 x=result_x_axis, 
                 y=result_y_axis, 
@@ -681,7 +2061,7 @@ def process_scatter_chart(vis_res_list, care_weight_dict):
             print('*' * len(result_info[-1]))            
             break
 
-def process_pie_chart(vis_res_list):
+def process_pie_chart(vis_res_list, working_set):
     ''' Visualizing data in pie chart and print recommendation info.
     
     Parameters
@@ -689,10 +2069,14 @@ def process_pie_chart(vis_res_list):
     vis_res_list: list
         a list of words in user's input command
     
+    working_set: WorkingSet
+        the visualized search
+    
     Returns
     -------
     None
     '''
+    import plotly.graph_objs as go
     while True:
         sql_selection = ''
         if len(vis_res_list) != 2:
@@ -710,17 +2094,8 @@ def process_pie_chart(vis_res_list):
                 break
         
 
-        sql_statement_pie = '''
-            SELECT Business.name, 
-            Business.review_count, Business.rating, Business.price_level,
-            Business.recommendation_score,
-            Business.location_display_address,
-            Business.display_phone
-            From Business
-            ORDER BY Business.recommendation_score DESC
-        '''
-
-        result_list = cur.execute(sql_statement_pie).fetchall()
+        result_list = working_set.get_rows(['name', 'review_count', 'rating', 'price_level',
+            'recommendation_score', 'location_display_address', 'display_phone'])
 
         # Pie plot
         review_count_list_pie = []
@@ -732,11 +2107,11 @@ def process_pie_chart(vis_res_list):
             review_count_list_pie.append(result[1])
             rating_list_pie.append(result[2])
             price_level_pie.append(result[3])
-            if result_list.index(result) <= 6:
-                info_str = '[' + str(result_list.index(result) + 1) + '] ' + result[0] + ', recommendation score is {rs:0.3f}'.format(rs=result[4])
-                info_str += ', with review_count=' + str(result[1]) + ', price_level=' + str(result[3])
-                info_str += ', rating=' + str(result[2]) +'. Address: ' + result[5] + '. Phone: ' + result[6] 
-                result_info.append(info_str)
+        for result_pos, result in enumerate(get_top_results(result_list, 4)):
+            info_str = '[' + str(result_pos + 1) + '] ' + result[0] + ', recommendation score is {rs:0.3f}'.format(rs=result[4])
+            info_str += ', with review_count=' + str(result[1]) + ', price_level=' + str(result[3])
+            info_str += ', rating=' + str(result[2]) +'. Address: ' + result[5] + '. Phone: ' + result[6] 
+            result_info.append(info_str)
 
         if sql_selection == 'review_count':
             labels = ['>2500', '1500~2500', '800~1499', '500~799','<500']
@@ -816,7 +2191,7 @@ def process_pie_chart(vis_res_list):
         print('*' * len(result_info[-1]))            
         break
 
-def process_bubble_chart(vis_res_list, care_weight_dict):
+def process_bubble_chart(vis_res_list, care_weight_dict, working_set):
     ''' Visualizing data in bubble chart and print recommendation info.
     
     Parameters
@@ -824,10 +2199,17 @@ def process_bubble_chart(vis_res_list, care_weight_dict):
     vis_res_list: list
         a list of words in user's input command
     
+    care_weight_dict: dict
+        a dictionary of user's care level and weight
+    
+    working_set: WorkingSet
+        the visualized search
+    
     Returns
     -------
     None
     '''
+    import plotly.graph_objs as go
     while True:
         # command can only be 'bubble'
         if vis_res_list == ['bubble']:
@@ -849,16 +2231,8 @@ def process_bubble_chart(vis_res_list, care_weight_dict):
         color = []
         result_info = []
 
-        sql_statement_bubble = '''
-            SELECT Business.name, 
-            Business.{}, Business.{},
-            Business.recommendation_score,
-            Business.location_display_address,
-            Business.display_phone
-            From Business
-            ORDER BY Business.recommendation_score DESC
-        '''.format(x_axis_lable, y_axis_lable)
-        result_list = cur.execute(sql_statement_bubble).fetchall()
+        result_list = working_set.get_rows(['name', x_axis_lable, y_axis_lable,
+            'recommendation_score', 'location_display_address', 'display_phone'])
 
         for result in result_list:
             xval.append(result[1])
@@ -869,11 +2243,11 @@ def process_bubble_chart(vis_res_list, care_weight_dict):
                 random.randint(1,255), 
                 random.randint(1,255), 
                 random.randint(1,255)))
-            if result_list.index(result) <= 6:
-                info_str = '[' + str(result_list.index(result) + 1) + '] ' + result[0] + ', recommendation score is {rs:0.3f}'.format(rs=result[3])
-                info_str += ', with {}='.format(x_axis_lable) + str(result[1]) + ', {}='.format(y_axis_lable) + str(result[2])
-                info_str += '. Address: ' + result[4] + '. Phone: ' + result[5] 
-                result_info.append(info_str)
+        for result_pos, result in enumerate(get_top_results(result_list, 3)):
+            info_str = '[' + str(result_pos + 1) + '] ' + result[0] + ', recommendation score is {rs:0.3f}'.format(rs=result[3])
+            info_str += ', with {}='.format(x_axis_lable) + str(result[1]) + ', {}='.format(y_axis_lable) + str(result[2])
+            info_str += '. Address: ' + result[4] + '. Phone: ' + result[5] 
+            result_info.append(info_str)
         
         fig = go.Figure(data=go.Scatter(
             x=xval, y=yval,
@@ -893,6 +2267,25 @@ def process_bubble_chart(vis_res_list, care_weight_dict):
         print('*' * len(result_info[-1]))            
         break
 
+def get_top_results(result_list, score_loc):
+    ''' Pick the best rows of a chart query with a bounded heap instead of
+    sorting every row.
+
+    Parameters
+    ----------
+    result_list: list
+        a list of rows of a chart query
+
+    score_loc: integer
+        the position of the recommendation score in a row
+
+    Returns
+    -------
+    list
+        the TOP_RECOMMENDATION_COUNT rows with the highest score, best first
+    '''
+    return heapq.nlargest(TOP_RECOMMENDATION_COUNT, result_list, key=lambda result: result[score_loc])
+
 def prompt_print(business_instance):
     ''' Print recommendation info if only one or two matches are found.
 
@@ -916,217 +2309,1975 @@ def prompt_print(business_instance):
     except:
         pass
     
-def get_business_instance_list(url_category):
+def get_business_instance_list(url_category, store=True):
     ''' Make a list of business instances from a specific url.
 
     Parameters
     ----------
     url_category: string
         the component of a url which is to be requested upon
+
+    store: boolean
+        False leaves the fetched search out of the local store, for a
+        WorkingSet that is flushed later; otherwise the search is stored
+        in one transaction once every page arrived
     
     Returns
     -------
     business_instance_list: list
         a list of business instances
     '''
-    CACHE_DICT = load_cache()
-    business_response = make_url_request_using_cache(url_category, CACHE_DICT)
-    
-    business_list = business_response['businesses'] # a list of business dict
+    search_id = get_search_id(url_category)
+    if search_id is not None:
+        return get_stored_business_instance_list(search_id)
+
+    page_dict = {}
+    def ingest_page(offset, business_response):
+        page_dict[offset] = get_page_business_instance_list(business_response)
+
+    fetch_search_pages(url_category, ingest_page)
+
     business_instance_list = []
+    for offset in sorted(page_dict):
+        business_instance_list.extend(page_dict[offset])
+    if store and len(business_instance_list) > 0:
+        store_business_instance_list(business_instance_list, url_category)
+    return business_instance_list
 
-    if len(business_list) == 0:
-        return []
+def get_page_business_instance_list(business_response):
+    ''' Make a list of business instances from one page of search results.
+
+    Parameters
+    ----------
+    business_response: dict
+        the json response of a search url, raw or projected
+    
+    Returns
+    -------
+    business_instance_list: list
+        a list of business instances
+    '''
+    if 'rows' in business_response:
+        business_row_list = business_response['rows']
     else:
-        for business in business_list:
-            business_id = business['id']
-            business_alias = business['alias']
-            business_name = business['name']
-            business_url = business['url']
-            business_review_count = business['review_count']
-            business_category_list = []
-            for item in business['categories']:
-                business_category_list.append(item['title'])
-            business_rating = business['rating']
-            price_level_list = [1, 1, 2, 3, 4, 5, 6]
+        business_row_list = [get_business_fields(business) for business in business_response.get('businesses', [])]
+    return [Business(*business_row) for business_row in business_row_list]
+
+def get_business_fields(business):
+    ''' Extract the fields the program uses from a business of a search
+    response, in the order of the Business constructor.
+
+    Parameters
+    ----------
+    business: dict
+        a business of the json response of a search url
+
+    Returns
+    -------
+    list
+        the arguments of Business
+    '''
+    business_category_list = []
+    for item in business['categories']:
+        business_category_list.append(item['title'])
+    price_level_list = [1, 1, 2, 3, 4, 5, 6]
+    try:
+        business_price_level = price_level_list[len(business['price']) + 1]
+    except:
+        business_price_level = price_level_list[0]
+
+    return [business['id'], business['alias'], business['name'], business['url'],
+        business['review_count'], business_category_list, business['rating'], business_price_level,
+        business['location']['zip_code'], business['location']['city'], business['location']['state'],
+        business['location']['country'], business['location']['display_address'], business['display_phone']]
+
+def project_search_response(business_response):
+    ''' Reduce a search response to the fields the program uses before it
+    is cached: one packed row of Business arguments per business, tagged
+    with SEARCH_PROJECTION_VERSION. The raw response is only kept when
+    CACHE_RAW_RESPONSES is set.
+
+    Parameters
+    ----------
+    business_response: object
+        the json response of a search url, or any other cached value
+
+    Returns
+    -------
+    object
+        the projected response; values that are not search results are
+        returned unchanged
+    '''
+    if not isinstance(business_response, dict) or 'businesses' not in business_response:
+        return business_response
+    projected_response = {
+        'schema': SEARCH_PROJECTION_VERSION,
+        'total': business_response.get('total', 0),
+        'rows': [get_business_fields(business) for business in business_response['businesses']],
+    }
+    if CACHE_RAW_RESPONSES:
+        projected_response['raw'] = business_response
+    return projected_response
+
+def get_response_business_count(business_response):
+    ''' Count the businesses of a raw or projected search response.
+
+    Parameters
+    ----------
+    business_response: dict
+        the json response of a search url
+
+    Returns
+    -------
+    integer
+        the number of businesses on the page
+    '''
+    if 'rows' in business_response:
+        return len(business_response['rows'])
+    return len(business_response.get('businesses', []))
+
+def fetch_search_pages(url_category, page_callback, max_results=SEARCH_MAX_RESULTS):
+    ''' Fetch every page of a search, the first one alone to learn the
+    reported total and the remaining offsets concurrently on a thread pool.
+
+    Pages are handed to page_callback on the calling thread as soon as
+    they arrive, so parsing overlaps the remaining requests. A page
+    answered with an error raises SearchFailedError before it is handed
+    over and cancels the pages not requested yet, so a search is never
+    taken for complete with pages missing.
+
+    Parameters
+    ----------
+    url_category: string
+        the url of the first page, including its limit parameter
+
+    page_callback: function
+        called with (offset, json response) for every page
+
+    max_results: integer
+        the maximum number of results fetched
+
+    Returns
+    -------
+    integer
+        the number of pages fetched
+    '''
+    cache = load_cache()
+    first_page = make_url_request_using_cache(url_category, cache)
+    check_search_response(first_page)
+    page_callback(0, first_page)
+
+    offsets = get_search_offsets(first_page, max_results)[1:]
+    if len(offsets) == 0:
+        return 1
+
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        future_dict = {}
+        for offset in offsets:
+            page_url = url_category + '&offset=' + str(offset)
+            future_dict[executor.submit(make_url_request_using_cache, page_url, cache)] = offset
+        try:
+            for future in as_completed(future_dict):
+                business_response = future.result()
+                check_search_response(business_response)
+                page_callback(future_dict[future], business_response)
+        except Exception:
+            for future in future_dict:
+                future.cancel()
+            raise
+    return len(offsets) + 1
+
+def get_search_offsets(first_page, max_results=SEARCH_MAX_RESULTS):
+    ''' List the offsets of every page of a search, as far as its first
+    page tells.
+
+    Parameters
+    ----------
+    first_page: dict
+        the json response of the first page, raw or projected
+
+    max_results: integer
+        the maximum number of results fetched
+
+    Returns
+    -------
+    list
+        the offsets of the pages, starting with 0
+    '''
+    total = min(first_page.get('total', 0), max_results)
+    if get_response_business_count(first_page) < SEARCH_PAGE_SIZE:
+        total = 0
+    return [0] + list(range(SEARCH_PAGE_SIZE, total, SEARCH_PAGE_SIZE))
+
+def check_search_response(business_response):
+    ''' Raise SearchFailedError if a page of a search is an error response.
+
+    Parameters
+    ----------
+    business_response: dict
+        the json response of a page, raw or projected
+
+    Returns
+    -------
+    None
+    '''
+    if 'error' in business_response:
+        error = business_response['error']
+        raise SearchFailedError(str(error.get('code')) + ', ' + str(error.get('description')))
+
+def fetch_search_response_pages(url_category):
+    ''' Fetch every page of a search without ingesting it, so it can run
+    on a worker thread.
+
+    Parameters
+    ----------
+    url_category: string
+        the url of the first page of the search
+
+    Returns
+    -------
+    list
+        a list of (offset, json response) tuples
+    '''
+    page_list = []
+    fetch_search_pages(url_category, lambda offset, business_response: page_list.append((offset, business_response)))
+    return page_list
+
+def search_multiple_cities(url_dict, care_weight_dict, k=TOP_RECOMMENDATION_COUNT):
+    ''' Search several cities concurrently and merge their rankings.
+
+    Cities are fetched on a thread pool through the response cache and
+    ingested on the calling thread as each city completes; a city whose
+    search fails is left out. Every city is
+    scored on its own, only its k best businesses are taken from its
+    score heap, and the per-city lists are combined with a k-way heap merge.
+
+    Parameters
+    ----------
+    url_dict: dict
+        key is a city and value is the url of its search
+
+    care_weight_dict: dict
+        a dictionary of care level and weight
+
+    k: integer
+        the number of businesses returned
+
+    Returns
+    -------
+    list
+        a list of (score, business id, city) tuples, best first
+    '''
+    search_id_dict = {}
+    pending_url_dict = {}
+    for city, url_category in url_dict.items():
+        search_id = get_search_id(url_category)
+        if search_id is not None:
+            search_id_dict[city] = search_id
+        else:
+            pending_url_dict[city] = url_category
+
+    with ThreadPoolExecutor(max_workers=MULTI_CITY_WORKERS) as executor:
+        future_dict = {}
+        for city, url_category in pending_url_dict.items():
+            future_dict[executor.submit(fetch_search_response_pages, url_category)] = city
+        for future in as_completed(future_dict):
+            city = future_dict[future]
             try:
-                business_price_level = price_level_list[len(business['price']) + 1]
-            except:
-                business_price_level = price_level_list[0]
-            business_location_zip_code = business['location']['zip_code']
-            business_location_city = business['location']['city']
-            business_location_state = business['location']['state']
-            business_location_country = business['location']['country']
-            business_display_address_list = business['location']['display_address']
-            business_display_phone = business['display_phone']
-
-            business_instance = Business(business_id, business_alias, business_name, business_url,
-                business_review_count, business_category_list, business_rating, business_price_level,
-                business_location_zip_code, business_location_city, business_location_state, 
-                business_location_country, business_display_address_list, business_display_phone)
-            
-            business_instance_list.append(business_instance)
+                page_list = future.result()
+            except SearchFailedError as error:
+                print('Search in ' + city + ' failed: ' + str(error))
+                continue
+            business_instance_list = []
+            for offset, business_response in sorted(page_list, key=lambda page: page[0]):
+                business_instance_list.extend(get_page_business_instance_list(business_response))
+            if len(business_instance_list) > 0:
+                store_business_instance_list(business_instance_list, pending_url_dict[city])
+            search_id = get_search_id(pending_url_dict[city])
+            if search_id is not None:
+                search_id_dict[city] = search_id
+
+    weights = tuple(care_weight_dict[column] for column in CARE_COLUMNS)
+    city_ranking_list = []
+    for city, search_id in search_id_dict.items():
+        city_ranking = get_score_matrix(search_id).top(weights, k)
+        city_ranking_list.append([(score, business_id, city) for business_id, score in city_ranking])
+
+    ranking = []
+    seen = set()
+    for score, business_id, city in heapq.merge(*city_ranking_list, key=lambda item: item[0], reverse=True):
+        if business_id in seen:
+            continue
+        seen.add(business_id)
+        ranking.append((score, business_id, city))
+        if len(ranking) == k:
+            break
+    return ranking
+
+def get_business_detail_dict(business_ids):
+    ''' Read what is shown about recommended businesses with one query.
+
+    Parameters
+    ----------
+    business_ids: list
+        Ids of businesses in Business
+
+    Returns
+    -------
+    dict
+        key is a business id and value is its (id, name, review count,
+        price level, rating, address, phone, city) row
+    '''
+    sql_statement = '''
+        SELECT Business.id, Business.name, Business.review_count, Business.price_level,
+        Business.rating, Business.location_display_address, Business.display_phone,
+        Business.location_city
+        FROM Business
+        WHERE Business.id IN ({})
+    '''.format(', '.join('?' * len(business_ids)))
+    return {row[0]: row for row in get_cursor().execute(sql_statement, business_ids).fetchall()}
+
+def print_multi_city_recommendations(ranking):
+    ''' Print the merged recommendations of a multi-city search.
+
+    Parameters
+    ----------
+    ranking: list
+        a list of (score, business id, city) tuples, best first
+
+    Returns
+    -------
+    None
+    '''
+    business_dict = get_business_detail_dict([business_id for score, business_id, city in ranking])
+
+    result_info = []
+    for result_pos, (score, business_id, city) in enumerate(ranking):
+        result = business_dict[business_id]
+        info_str = '[' + str(result_pos + 1) + '] ' + result[1] + ' (' + city + '), recommendation score is {rs:0.3f}'.format(rs=score)
+        info_str += ', with review_count=' + str(result[2]) + ', price_level=' + str(result[3])
+        info_str += ', rating=' + str(result[4]) + '. Address: ' + result[5] + '. Phone: ' + result[6]
+        result_info.append(info_str)
+
+    print('*' * len(result_info[-1]))
+    for info in result_info:
+        print(info)
+    print('*' * len(result_info[-1]))
+
+def get_locale_id_dict():
+    ''' Map alpha-2 country codes to Locale ids, built once per process.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    dict
+        key is an alpha-2 code (e.g. US) and value is the Id in Locale
+    '''
+    global LOCALE_ID_DICT
+    with CATEGORY_LOCK:
+        if LOCALE_ID_DICT is None:
+            get_locale_code()
+            sql_statement = '''
+                SELECT Locale.alpha2, MIN(Locale.Id) FROM Locale
+                GROUP BY Locale.alpha2
+            '''
+            LOCALE_ID_DICT = dict(get_cursor().execute(sql_statement).fetchall())
+        return LOCALE_ID_DICT
+
+def get_business_row(instance, locale_id_dict):
+    ''' Convert a business instance into a row of the Business table.
+
+    Parameters
+    ----------
+    instance: object
+        an instance of a business class
+
+    locale_id_dict: dict
+        key is an alpha-2 code and value is the Id in Locale
+
+    Returns
+    -------
+    list
+        the column values of the row, without the Id; the categories
+        go to BusinessCategory
+    '''
+    return [
+        instance.id, instance.alias, instance.name, instance.url,
+        instance.review_count, instance.rating, instance.price_level, instance.location_zip_code, instance.location_city,
+        instance.location_state,
+        # foreign key referred to Locale.Id
+        locale_id_dict.get(instance.location_country),
+        get_display_address(instance), instance.display_phone
+        ]
+
+def get_display_address(instance):
+    ''' Join the displayed address lines of a business.
+
+    Parameters
+    ----------
+    instance: object
+        an instance of a business class
+
+    Returns
+    -------
+    string
+        the displayed address, 'Null' if the business has none
+    '''
+    try:
+        return ' '.join(instance.location_display_address_list).strip()
+    except TypeError:
+        return 'Null'
+
+def create_business_tables():
+    ''' Create the Business store and the Search tables once per process.
+
+    Business accumulates every fetched business keyed by its yelp id,
+    BusinessCategory lists the category titles of every business in yelp's
+    order, Search records every fetched url and SearchResult records which
+    businesses each search returned, in rank order, with their
+    recommendation score for that search. A version 2 store, which kept
+    three categories in Business itself, is migrated in place.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
+    '''
+    global BUSINESS_TABLES_READY
+    if BUSINESS_TABLES_READY:
+        return
+
+    business_schema_version = get_meta('business_schema_version')
+    if business_schema_version == '2':
+        get_cursor().execute('ALTER TABLE "Business" RENAME TO "BusinessV2"')
+    elif business_schema_version != BUSINESS_SCHEMA_VERSION:
+        # the old Business table only held the latest search
+        get_cursor().execute('DROP TABLE IF EXISTS "SearchResult"')
+        get_cursor().execute('DROP TABLE IF EXISTS "Search"')
+        get_cursor().execute('DROP TABLE IF EXISTS "Business"')
+
+    sql_statement = '''
+        CREATE TABLE IF NOT EXISTS "Business" (
+        "id"	INTEGER,
+        "yelp_id"	TEXT NOT NULL UNIQUE,
+        "alias"	TEXT,
+        "name"	TEXT NOT NULL,
+        "url"	TEXT,
+        "review_count"	INTEGER,
+        "rating"	REAL,
+        "price_level"	INTEGER,
+        "location_zip_code"	TEXT,
+        "location_city"	TEXT,
+        "location_state"	TEXT,
+        "location_country"	INTEGER,
+        "location_display_address"	TEXT,
+        "display_phone"	TEXT,
+        "content_hash"	TEXT NOT NULL,
+        PRIMARY KEY("Id" AUTOINCREMENT)
+    )
+    '''
+    get_cursor().execute(sql_statement)
+
+    sql_statement = '''
+        CREATE TABLE IF NOT EXISTS "BusinessCategory" (
+        "business_id"	INTEGER NOT NULL,
+        "position"	INTEGER NOT NULL,
+        "category"	TEXT NOT NULL,
+        PRIMARY KEY("business_id", "position")
+    ) WITHOUT ROWID
+    '''
+    get_cursor().execute(sql_statement)
+
+    if business_schema_version == '2':
+        sql_statement = '''
+            INSERT INTO Business
+            SELECT id, yelp_id, alias, name, url, review_count, rating, price_level,
+            location_zip_code, location_city, location_state, location_country,
+            location_display_address, display_phone, content_hash
+            FROM BusinessV2
+        '''
+        get_cursor().execute(sql_statement)
+        for position in range(3):
+            sql_statement = '''
+                INSERT OR IGNORE INTO BusinessCategory
+                SELECT id, ?, category_{} FROM BusinessV2
+                WHERE category_{} IS NOT NULL AND category_{} != 'Null'
+            '''.format(position + 1, position + 1, position + 1)
+            get_cursor().execute(sql_statement, [position])
+        get_cursor().execute('DROP TABLE "BusinessV2"')
+
+    sql_statement = '''
+        CREATE TABLE IF NOT EXISTS "Search" (
+        "Id"	INTEGER,
+        "url"	TEXT NOT NULL UNIQUE,
+        "fetched_at"	REAL NOT NULL,
+        "result_count"	INTEGER NOT NULL,
+        PRIMARY KEY("Id" AUTOINCREMENT)
+    )
+    '''
+    get_cursor().execute(sql_statement)
+
+    sql_statement = '''
+        CREATE TABLE IF NOT EXISTS "SearchResult" (
+        "search_id"	INTEGER NOT NULL,
+        "business_id"	INTEGER NOT NULL,
+        "rank"	INTEGER NOT NULL,
+        "recommendation_score"	REAL,
+        PRIMARY KEY("search_id", "business_id")
+    ) WITHOUT ROWID
+    '''
+    get_cursor().execute(sql_statement)
+
+    for index_name, table, columns in BUSINESS_INDEXES:
+        sql_statement = 'CREATE INDEX IF NOT EXISTS "{}" ON "{}" ({})'.format(index_name, table, columns)
+        get_cursor().execute(sql_statement)
+    set_meta('business_schema_version', BUSINESS_SCHEMA_VERSION)
+    get_connection().commit()
+    BUSINESS_TABLES_READY = True
+
+def check_query_plans():
+    ''' Check with EXPLAIN QUERY PLAN that the lookups of QUERY_PLAN_CHECKS
+    are served by indexes: none may scan a whole store table, and the
+    ordered ones may not sort in a temporary b-tree.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    boolean
+        True if every plan passes
+    '''
+    create_business_tables()
+    store_tables = ['Business', 'BusinessCategory', 'SearchResult']
+    all_passed = True
+    for name, sql_statement, params, ordered in QUERY_PLAN_CHECKS:
+        plan = [row[3] for row in get_cursor().execute('EXPLAIN QUERY PLAN ' + sql_statement, params).fetchall()]
+        problems = []
+        for detail in plan:
+            words = detail.replace('SCAN TABLE ', 'SCAN ').split()
+            if words[0] == 'SCAN' and words[1] in store_tables:
+                problems.append('full scan of ' + words[1])
+            if ordered and detail.startswith('USE TEMP B-TREE'):
+                problems.append('sort without an index')
+        all_passed = all_passed and len(problems) == 0
+        print('{:40}{}'.format(name, 'ok' if len(problems) == 0 else ', '.join(problems)))
+        print('    ' + ' / '.join(plan))
+    return all_passed
+
+def get_search_id(url_category):
+    ''' Find a stored search of a url that is still fresh.
+
+    Parameters
+    ----------
+    url_category: string
+        the url of the search
+
+    Returns
+    -------
+    integer
+        the Id of the search in Search, None if it was never stored or
+        is older than SEARCH_CACHE_TTL
+    '''
+    create_business_tables()
+    sql_statement = '''
+        SELECT Search.Id FROM Search
+        WHERE Search.url = ? AND Search.fetched_at > ?
+    '''
+    row = get_cursor().execute(sql_statement, [url_category, time.time() - SEARCH_CACHE_TTL]).fetchone()
+    if row is None:
+        return None
+    return row[0]
+
+def get_stored_business_instance_list(search_id):
+    ''' Rebuild the business instances of a stored search from the local store.
+
+    Parameters
+    ----------
+    search_id: integer
+        the Id of the search in Search
+
+    Returns
+    -------
+    business_instance_list: list
+        a list of business instances in the order yelp returned them
+    '''
+    sql_statement = '''
+        SELECT BusinessCategory.business_id, BusinessCategory.category
+        FROM SearchResult
+        JOIN BusinessCategory ON SearchResult.business_id = BusinessCategory.business_id
+        WHERE SearchResult.search_id = ?
+        ORDER BY BusinessCategory.business_id, BusinessCategory.position
+    '''
+    category_dict = {}
+    for business_id, category in get_cursor().execute(sql_statement, [search_id]).fetchall():
+        category_dict.setdefault(business_id, []).append(category)
+
+    sql_statement = '''
+        SELECT Business.id, Business.yelp_id, Business.alias, Business.name, Business.url,
+        Business.review_count, Business.rating, Business.price_level, Business.location_zip_code,
+        Business.location_city, Business.location_state, Locale.alpha2,
+        Business.location_display_address, Business.display_phone
+        FROM SearchResult
+        JOIN Business ON SearchResult.business_id = Business.id
+        LEFT JOIN Locale ON Business.location_country = Locale.Id
+        WHERE SearchResult.search_id = ?
+        ORDER BY SearchResult.rank ASC
+    '''
+    business_instance_list = []
+    for row in get_cursor().execute(sql_statement, [search_id]).fetchall():
+        business_instance_list.append(Business(row[1], row[2], row[3], row[4], row[5],
+            category_dict.get(row[0], []), row[6], row[7], row[8], row[9], row[10], row[11], [row[12]], row[13]))
+    return business_instance_list
+
+def store_business_instance_list(business_instance_list, url_category, score_list=None):
+    ''' Upsert a list of businesses into the Business store and record them
+    as the results of a search, all in one transaction. The businesses
+    replace the previous results of the search and are only stored once
+    every page of the search arrived, so a fresh Search row is always
+    complete.
+
+    Rows whose content hash did not change are left untouched, and so
+    are their categories.
+
+    Parameters
+    ----------
+    business_instance_list: list
+        a list of business instances
+
+    url_category: string
+        the url of the search that returned the businesses
+
+    score_list: list
+        the recommendation score of each business, 0.0 for all of them
+        when None
+
+    Returns
+    -------
+    float
+        the ingest throughput in rows per second
+    '''
+    start_time = time.perf_counter()
+    create_business_tables()
+    locale_id_dict = get_locale_id_dict()
+    business_rows = []
+    category_rows = []
+    for instance in business_instance_list:
+        business_row = get_business_row(instance, locale_id_dict)
+        category_list = list(instance.category_title_list)
+        content_hash = hashlib.sha1(json.dumps(business_row + [category_list]).encode('utf-8')).hexdigest()
+        business_rows.append(business_row + [content_hash])
+        for position, category in enumerate(category_list):
+            category_rows.append([position, category, business_row[0]])
+
+    # only new or changed businesses are written, with their categories
+    sql_statement = '''
+    SELECT Business.yelp_id, Business.content_hash FROM Business
+    WHERE Business.yelp_id IN ({})
+    '''.format(', '.join('?' * len(business_rows)))
+    stored_hash_dict = dict(get_cursor().execute(sql_statement, [business_row[0] for business_row in business_rows]).fetchall())
+    changed_rows = [business_row for business_row in business_rows if stored_hash_dict.get(business_row[0]) != business_row[-1]]
+    changed_ids = set(business_row[0] for business_row in changed_rows)
+
+    sql_statement = '''
+    INSERT INTO Business
+    VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT("yelp_id") DO UPDATE SET
+    alias = excluded.alias, name = excluded.name, url = excluded.url,
+    review_count = excluded.review_count,
+    rating = excluded.rating, price_level = excluded.price_level,
+    location_zip_code = excluded.location_zip_code, location_city = excluded.location_city,
+    location_state = excluded.location_state, location_country = excluded.location_country,
+    location_display_address = excluded.location_display_address,
+    display_phone = excluded.display_phone, content_hash = excluded.content_hash
+    WHERE Business.content_hash != excluded.content_hash
+    '''
+    get_cursor().executemany(sql_statement, changed_rows)
+    changed_count = len(changed_ids)
+
+    sql_statement = '''
+    DELETE FROM BusinessCategory WHERE BusinessCategory.business_id =
+        (SELECT Business.id FROM Business WHERE Business.yelp_id = ?)
+    '''
+    get_cursor().executemany(sql_statement, [[yelp_id] for yelp_id in changed_ids])
+    sql_statement = '''
+    INSERT OR IGNORE INTO BusinessCategory
+    SELECT Business.id, ?, ? FROM Business WHERE Business.yelp_id = ?
+    '''
+    get_cursor().executemany(sql_statement, [category_row for category_row in category_rows if category_row[2] in changed_ids])
+
+    sql_statement = '''
+    INSERT INTO Search (url, fetched_at, result_count)
+    VALUES (?, ?, ?)
+    ON CONFLICT("url") DO UPDATE SET
+    fetched_at = excluded.fetched_at, result_count = excluded.result_count
+    '''
+    get_cursor().execute(sql_statement, [url_category, time.time(), len(business_rows)])
+    search_id = get_cursor().execute('SELECT Search.Id FROM Search WHERE Search.url = ?', [url_category]).fetchone()[0]
+
+    get_cursor().execute('DELETE FROM SearchResult WHERE SearchResult.search_id = ?', [search_id])
+    sql_statement = '''
+    INSERT OR IGNORE INTO SearchResult
+    SELECT ?, Business.id, ?, ? FROM Business WHERE Business.yelp_id = ?
+    '''
+    if score_list is None:
+        score_list = [0.0] * len(business_rows)
+    search_result_rows = []
+    for rank, (business_row, score) in enumerate(zip(business_rows, score_list)):
+        search_result_rows.append([search_id, rank, score, business_row[0]])
+    get_cursor().executemany(sql_statement, search_result_rows)
+    sql_statement = '''
+    UPDATE Search SET result_count = (
+        SELECT COUNT(*) FROM SearchResult WHERE SearchResult.search_id = Search.Id)
+    WHERE Search.Id = ?
+    '''
+    get_cursor().execute(sql_statement, [search_id])
+    get_connection().commit()
+    with SCORE_MATRIX_LOCK:
+        score_matrix = SCORE_MATRIX_CACHE.get(search_id)
+    if score_matrix is not None:
+        score_matrix.sync(get_score_rows(search_id))
+
+    elapsed = time.perf_counter() - start_time
+    rows_per_second = len(business_rows) / elapsed if elapsed > 0 else float('inf')
+    if VERBOSE:
+        print('Stored {} businesses ({} new or changed) in {:0.1f} ms ({:0.0f} rows/s)'.format(
+            len(business_rows), changed_count, elapsed * 1000, rows_per_second))
+    return rows_per_second
+
+class ResponseCache:
+    '''an on-disk store of url responses backed by a sqlite table
+
+    Instance Attributes
+    -------------------
+    conn: object
+        the sqlite connection of the cache database
+
+    max_bytes: integer
+        the byte budget of all stored responses, least recently used
+        entries are evicted once it is exceeded
+
+    total_bytes: integer
+        the current size of all stored responses
+
+    hits, misses, evictions: integer
+        counters of lookups served, lookups missed and entries evicted
+    '''
+    def __init__(self, db_name=CACHE_DBNAME, max_bytes=CACHE_MAX_BYTES):
+        # only used under the lock of TieredCache
+        self.conn = final_proj_db.connect(db_name, check_same_thread=False)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        sql_statement = '''
+            CREATE TABLE IF NOT EXISTS "Cache" (
+            "key"	TEXT NOT NULL,
+            "value"	TEXT NOT NULL,
+            "size"	INTEGER NOT NULL,
+            "expires_at"	REAL,
+            "last_access"	REAL NOT NULL,
+            PRIMARY KEY("key")
+            )
+        '''
+        self.conn.execute(sql_statement)
+        self.conn.execute('CREATE INDEX IF NOT EXISTS "Cache_last_access" ON "Cache" ("last_access")')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS "Cache_expires_at" ON "Cache" ("expires_at")')
+
+        sql_statement = '''
+            CREATE TABLE IF NOT EXISTS "CacheMeta" (
+            "key"	TEXT NOT NULL,
+            "value"	TEXT,
+            PRIMARY KEY("key")
+            )
+        '''
+        self.conn.execute(sql_statement)
+        self.conn.commit()
+
+        sql_statement = '''
+            SELECT COALESCE(SUM(Cache.size), 0) FROM Cache
+        '''
+        self.total_bytes = self.conn.execute(sql_statement).fetchone()[0]
+
+    def get(self, key):
+        ''' Look up a response and mark it as recently used.
+
+        Parameters
+        ----------
+        key: string
+            the cache key, usually a url
+
+        Returns
+        -------
+        object
+            the cached response, None if it is missing or expired
+        '''
+        return self.get_entry(key)[0]
+
+    def get_entry(self, key):
+        ''' Look up a response together with its expiry time.
+
+        Parameters
+        ----------
+        key: string
+            the cache key, usually a url
+
+        Returns
+        -------
+        tuple
+            the cached response and its expiry timestamp, (None, None) if
+            it is missing or expired
+        '''
+        sql_statement = '''
+            SELECT Cache.value, Cache.expires_at FROM Cache
+            WHERE Cache.key = ?
+        '''
+        row = self.conn.execute(sql_statement, [key]).fetchone()
+        if row is None:
+            self.misses += 1
+            return None, None
+
+        now = time.time()
+        if row[1] is not None and row[1] <= now:
+            self.delete(key)
+            self.misses += 1
+            return None, None
+
+        sql_statement = '''
+            UPDATE Cache SET last_access = ? WHERE Cache.key = ?
+        '''
+        self.conn.execute(sql_statement, [now, key])
+        self.conn.commit()
+        self.hits += 1
+        return json.loads(row[0]), row[1]
+
+    def peek(self, key):
+        ''' Look up a response without counting the lookup or marking the
+        entry as recently used.
+
+        Parameters
+        ----------
+        key: string
+            the cache key, usually a url
+
+        Returns
+        -------
+        object
+            the cached response, None if it is missing or expired
+        '''
+        sql_statement = '''
+            SELECT Cache.value, Cache.expires_at FROM Cache
+            WHERE Cache.key = ?
+        '''
+        row = self.conn.execute(sql_statement, [key]).fetchone()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return None
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        ''' Store a response, evicting least recently used entries if the
+        byte budget is exceeded.
+
+        Parameters
+        ----------
+        key: string
+            the cache key, usually a url
+
+        value: object
+            a json serializable response
+
+        ttl: integer
+            seconds the entry stays valid, None means it never expires
+
+        Returns
+        -------
+        None
+        '''
+        # json.dumps escapes non-ascii characters, so len() is the byte size
+        value_text = json.dumps(value)
+        size = len(value_text)
+        now = time.time()
+        expires_at = None if ttl is None else now + ttl
+
+        sql_statement = '''
+            SELECT Cache.size FROM Cache WHERE Cache.key = ?
+        '''
+        old_row = self.conn.execute(sql_statement, [key]).fetchone()
+        old_size = 0 if old_row is None else old_row[0]
+
+        sql_statement = '''
+            INSERT OR REPLACE INTO Cache
+            VALUES (?, ?, ?, ?, ?)
+        '''
+        self.conn.execute(sql_statement, [key, value_text, size, expires_at, now])
+        self.conn.commit()
+        self.total_bytes += size - old_size
+
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def delete(self, key):
+        ''' Remove an entry from the cache.
+
+        Parameters
+        ----------
+        key: string
+            the cache key, usually a url
+
+        Returns
+        -------
+        None
+        '''
+        sql_statement = '''
+            SELECT Cache.size FROM Cache WHERE Cache.key = ?
+        '''
+        row = self.conn.execute(sql_statement, [key]).fetchone()
+        if row is not None:
+            self.conn.execute('DELETE FROM Cache WHERE Cache.key = ?', [key])
+            self.conn.commit()
+            self.total_bytes -= row[0]
+
+    def evict(self):
+        ''' Drop expired entries, then least recently used entries until
+        the cache fits into its byte budget.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        integer
+            the number of evicted entries
+        '''
+        now = time.time()
+        sql_statement = '''
+            SELECT COUNT(*), COALESCE(SUM(Cache.size), 0) FROM Cache
+            WHERE Cache.expires_at <= ?
+        '''
+        evicted_count, evicted_bytes = self.conn.execute(sql_statement, [now]).fetchone()
+        self.conn.execute('DELETE FROM Cache WHERE Cache.expires_at <= ?', [now])
+        self.total_bytes -= evicted_bytes
+
+        sql_statement = '''
+            SELECT Cache.key, Cache.size FROM Cache
+            ORDER BY Cache.last_access ASC
+            LIMIT 64
+        '''
+        while self.total_bytes > self.max_bytes:
+            oldest = self.conn.execute(sql_statement).fetchall()
+            if len(oldest) == 0:
+                break
+            victims = []
+            for key, size in oldest:
+                victims.append([key])
+                self.total_bytes -= size
+                if self.total_bytes <= self.max_bytes:
+                    break
+            self.conn.executemany('DELETE FROM Cache WHERE Cache.key = ?', victims)
+            evicted_count += len(victims)
+
+        self.conn.commit()
+        self.evictions += evicted_count
+        return evicted_count
+
+    def stats(self):
+        ''' Report the counters and size of the disk tier.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        dict
+            hits, misses, evictions, entries and bytes of the tier
+        '''
+        entries = self.conn.execute('SELECT COUNT(*) FROM Cache').fetchone()[0]
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': entries,
+            'bytes': self.total_bytes,
+        }
+
+    def migrate_json_cache(self, filename=CACHE_FILENAME, ttl_function=None):
+        ''' Copy the entries of the legacy json cache file into the store.
+        This only happens once, the file itself is left untouched.
+
+        Parameters
+        ----------
+        filename: string
+            the path of the legacy json cache file
+
+        ttl_function: function
+            maps a legacy response to the seconds it stays valid, 0 drops
+            the entry; None keeps every entry without expiry
+
+        Returns
+        -------
+        integer
+            the number of migrated entries
+        '''
+        sql_statement = '''
+            SELECT CacheMeta.value FROM CacheMeta WHERE CacheMeta.key = 'json_migrated'
+        '''
+        if self.conn.execute(sql_statement).fetchone() is not None:
+            return 0
+
+        try:
+            with open(filename, 'r') as cache_file:
+                legacy_cache = json.load(cache_file)
+        except (OSError, ValueError):
+            legacy_cache = {}
+
+        now = time.time()
+        rows = []
+        for key, value in legacy_cache.items():
+            ttl = None if ttl_function is None else ttl_function(value)
+            if ttl == 0:
+                continue
+            value_text = json.dumps(value)
+            rows.append([key, value_text, len(value_text), None if ttl is None else now + ttl, now])
+
+        sql_statement = '''
+            INSERT OR IGNORE INTO Cache
+            VALUES (?, ?, ?, ?, ?)
+        '''
+        self.conn.executemany(sql_statement, rows)
+        sql_statement = '''
+            INSERT OR REPLACE INTO CacheMeta
+            VALUES ('json_migrated', ?)
+        '''
+        self.conn.execute(sql_statement, [str(len(rows))])
+        self.conn.commit()
+
+        sql_statement = '''
+            SELECT COALESCE(SUM(Cache.size), 0) FROM Cache
+        '''
+        self.total_bytes = self.conn.execute(sql_statement).fetchone()[0]
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+        return len(rows)
+
+    def rekey(self, key_function, version):
+        ''' Move every entry to the key key_function gives it, once per
+        key version. Entries that collapse onto the same key keep the most
+        recently used response.
+
+        Parameters
+        ----------
+        key_function: function
+            maps a stored key to its current form
+
+        version: string
+            the version of key_function
+
+        Returns
+        -------
+        integer
+            the number of moved or merged entries
+        '''
+        sql_statement = '''
+            SELECT CacheMeta.value FROM CacheMeta WHERE CacheMeta.key = 'key_version'
+        '''
+        row = self.conn.execute(sql_statement).fetchone()
+        if row is not None and row[0] == version:
+            return 0
+
+        last_access_dict = dict(self.conn.execute('SELECT Cache.key, Cache.last_access FROM Cache').fetchall())
+        rekeyed_count = 0
+        for key in list(last_access_dict):
+            new_key = key_function(key)
+            if new_key == key:
+                continue
+            if new_key in last_access_dict and last_access_dict[new_key] >= last_access_dict[key]:
+                self.conn.execute('DELETE FROM Cache WHERE Cache.key = ?', [key])
+            else:
+                self.conn.execute('DELETE FROM Cache WHERE Cache.key = ?', [new_key])
+                self.conn.execute('UPDATE Cache SET key = ? WHERE Cache.key = ?', [new_key, key])
+                last_access_dict[new_key] = last_access_dict[key]
+            del last_access_dict[key]
+            rekeyed_count += 1
+
+        sql_statement = '''
+            INSERT OR REPLACE INTO CacheMeta
+            VALUES ('key_version', ?)
+        '''
+        self.conn.execute(sql_statement, [version])
+        self.conn.commit()
+
+        sql_statement = '''
+            SELECT COALESCE(SUM(Cache.size), 0) FROM Cache
+        '''
+        self.total_bytes = self.conn.execute(sql_statement).fetchone()[0]
+        return rekeyed_count
+
+    def migrate_values(self, value_function, version):
+        ''' Rewrite every stored response with value_function, once per
+        version, keeping keys and expiry times.
+
+        Parameters
+        ----------
+        value_function: function
+            maps a stored response to its current form
+
+        version: string
+            the version of value_function
+
+        Returns
+        -------
+        integer
+            the number of rewritten entries
+        '''
+        sql_statement = '''
+            SELECT CacheMeta.value FROM CacheMeta WHERE CacheMeta.key = 'value_version'
+        '''
+        row = self.conn.execute(sql_statement).fetchone()
+        if row is not None and row[0] == version:
+            return 0
+
+        rows = []
+        for key, value_text in self.conn.execute('SELECT Cache.key, Cache.value FROM Cache').fetchall():
+            new_value_text = json.dumps(value_function(json.loads(value_text)))
+            if new_value_text != value_text:
+                rows.append([new_value_text, len(new_value_text), key])
+        sql_statement = '''
+            UPDATE Cache SET value = ?, size = ? WHERE Cache.key = ?
+        '''
+        self.conn.executemany(sql_statement, rows)
+        sql_statement = '''
+            INSERT OR REPLACE INTO CacheMeta
+            VALUES ('value_version', ?)
+        '''
+        self.conn.execute(sql_statement, [version])
+        self.conn.commit()
+
+        sql_statement = '''
+            SELECT COALESCE(SUM(Cache.size), 0) FROM Cache
+        '''
+        self.total_bytes = self.conn.execute(sql_statement).fetchone()[0]
+        return len(rows)
+
+class MemoryCache:
+    '''an in-process LRU store of url responses
+
+    Instance Attributes
+    -------------------
+    entries: OrderedDict
+        cache keys mapped to (response, size, expires_at), least recently
+        used first
+
+    max_entries: integer
+        the maximum number of entries kept in memory
+
+    max_bytes: integer
+        the byte budget of all responses kept in memory
+
+    total_bytes: integer
+        the current size of all responses kept in memory
+
+    hits, misses, evictions: integer
+        counters of lookups served, lookups missed and entries evicted
+    '''
+    def __init__(self, max_entries=MEMORY_CACHE_MAX_ENTRIES, max_bytes=MEMORY_CACHE_MAX_BYTES):
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        ''' Look up a response and mark it as recently used.
+
+        Parameters
+        ----------
+        key: string
+            the cache key, usually a url
+
+        Returns
+        -------
+        object
+            the cached response, None if it is missing or expired
+        '''
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry[2] is not None and entry[2] <= time.time():
+            self.delete(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def peek(self, key):
+        ''' Look up a response without counting the lookup or marking the
+        entry as recently used.
+
+        Parameters
+        ----------
+        key: string
+            the cache key, usually a url
+
+        Returns
+        -------
+        object
+            the cached response, None if it is missing or expired
+        '''
+        entry = self.entries.get(key)
+        if entry is None or (entry[2] is not None and entry[2] <= time.time()):
+            return None
+        return entry[0]
+
+    def set(self, key, value, ttl=None, size=None):
+        ''' Store a response, evicting least recently used entries if the
+        entry or byte limit is exceeded.
+
+        Parameters
+        ----------
+        key: string
+            the cache key, usually a url
+
+        value: object
+            a json serializable response
+
+        ttl: integer
+            seconds the entry stays valid, None means it never expires
+
+        size: integer
+            the serialized size of the response, computed if not given
+
+        Returns
+        -------
+        None
+        '''
+        if size is None:
+            size = len(json.dumps(value))
+        if size > self.max_bytes:
+            return
+        self.delete(key)
+        expires_at = None if ttl is None else time.time() + ttl
+        self.entries[key] = (value, size, expires_at)
+        self.total_bytes += size
+
+        while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+            old_key, old_entry = self.entries.popitem(last=False)
+            self.total_bytes -= old_entry[1]
+            self.evictions += 1
+
+    def delete(self, key):
+        ''' Remove an entry from memory.
+
+        Parameters
+        ----------
+        key: string
+            the cache key, usually a url
+
+        Returns
+        -------
+        None
+        '''
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[1]
+
+    def stats(self):
+        ''' Report the counters and size of the memory tier.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        dict
+            hits, misses, evictions, entries and bytes of the tier
+        '''
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'bytes': self.total_bytes,
+        }
+
+class TieredCache:
+    '''a memory cache in front of a disk cache, disk is only touched on a
+    memory miss; safe to share between threads
+
+    Instance Attributes
+    -------------------
+    memory: MemoryCache
+        the in-process tier
+
+    disk: ResponseCache
+        the sqlite tier
+
+    lock: RLock
+        serializes access to both tiers
+    '''
+    def __init__(self, memory, disk):
+        self.memory = memory
+        self.disk = disk
+        self.lock = threading.RLock()
+
+    def get(self, key):
+        ''' Look up a response in memory first, then on disk.
+
+        Parameters
+        ----------
+        key: string
+            the cache key, usually a url
+
+        Returns
+        -------
+        object
+            the cached response, None if neither tier has it
+        '''
+        with self.lock:
+            response = self.memory.get(key)
+            if response is not None:
+                return response
+            response, expires_at = self.disk.get_entry(key)
+            if response is not None:
+                ttl = None if expires_at is None else expires_at - time.time()
+                self.memory.set(key, response, ttl)
+            return response
+
+    def peek(self, key):
+        ''' Look up a response in memory first, then on disk, without
+        counting the lookup in either tier.
+
+        Parameters
+        ----------
+        key: string
+            the cache key, usually a url
+
+        Returns
+        -------
+        object
+            the cached response, None if neither tier has it
+        '''
+        with self.lock:
+            response = self.memory.peek(key)
+            if response is not None:
+                return response
+            return self.disk.peek(key)
+
+    def set(self, key, value, ttl=None):
+        ''' Store a response in both tiers.
+
+        Parameters
+        ----------
+        key: string
+            the cache key, usually a url
+
+        value: object
+            a json serializable response
+
+        ttl: integer
+            seconds the entry stays valid, None means it never expires
+
+        Returns
+        -------
+        None
+        '''
+        with self.lock:
+            self.disk.set(key, value, ttl)
+            self.memory.set(key, value, ttl)
+
+    def delete(self, key):
+        ''' Remove an entry from both tiers.
+
+        Parameters
+        ----------
+        key: string
+            the cache key, usually a url
+
+        Returns
+        -------
+        None
+        '''
+        with self.lock:
+            self.memory.delete(key)
+            self.disk.delete(key)
+
+    def stats(self):
+        ''' Report the counters of each tier.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        dict
+            tier name mapped to its stats
+        '''
+        with self.lock:
+            return {'memory': self.memory.stats(), 'disk': self.disk.stats()}
+
+def print_cache_stats():
+    ''' Print hit/miss/eviction counters of every cache tier.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
+    '''
+    for tier, tier_stats in load_cache().stats().items():
+        lookups = tier_stats['hits'] + tier_stats['misses']
+        hit_rate = tier_stats['hits'] / lookups if lookups else 0.0
+        print('{tier:8}hits={hits}, misses={misses}, hit rate={rate:0.1%}, evictions={evictions}, '
+            'entries={entries}, bytes={bytes}'.format(tier=tier, rate=hit_rate, **tier_stats))
+    flight_stats = get_single_flight().stats()
+    print('{tier:8}upstream requests={upstream}, coalesced={coalesced} (upstream calls saved)'.format(
+        tier='flight', **flight_stats))
+
+def load_cache():
+    '''Opening the cache store once per process, migrating the legacy
+    json cache file on first use.
+    
+    Parameters
+    ----------
+    None
+    
+    Returns
+    -------
+    TieredCache
+        the shared cache store, an in-memory tier in front of the disk
+    '''
+    global CACHE_STORE
+    if CACHE_STORE is None:
+        with CACHE_STORE_LOCK:
+            if CACHE_STORE is None:
+                disk_cache = ResponseCache(CACHE_DBNAME)
+                disk_cache.migrate_json_cache(CACHE_FILENAME, get_legacy_response_ttl)
+                disk_cache.rekey(get_cache_key, CACHE_KEY_VERSION)
+                disk_cache.migrate_values(project_search_response, str(SEARCH_PROJECTION_VERSION))
+                CACHE_STORE = TieredCache(MemoryCache(), disk_cache)
+    return CACHE_STORE
+
+def get_cache_key(url):
+    ''' Build the canonical cache key of a url, so urls asking for the same
+    response share one entry.
+
+    Scheme and host are lowercased, query parameters are trimmed, sorted
+    and stripped of blank values and of defaults in
+    CACHE_KEY_DEFAULT_PARAMS, the location is lowercased without spaces
+    and the categories are sorted. The api key travels in a header and is
+    never part of the key.
+
+    Parameters
+    ----------
+    url: string
+        a url to be requested upon
+
+    Returns
+    -------
+    string
+        the cache key of the url
+    '''
+    url_parts = urlsplit(url.strip())
+    params = []
+    for name, value in parse_qsl(url_parts.query):
+        name = name.strip().lower()
+        value = value.strip()
+        if name == 'location':
+            value = value.lower().replace(' ', '')
+        elif name == 'categories':
+            value = ','.join(sorted(set(alias.strip().lower() for alias in value.split(',') if alias.strip() != '')))
+        if value == '' or CACHE_KEY_DEFAULT_PARAMS.get(name) == value:
+            continue
+        params.append((name, value))
+    query = urlencode(sorted(params), safe=',')
+    return urlunsplit((url_parts.scheme.lower(), url_parts.netloc.lower(), url_parts.path, query, ''))
+
+class QuotaExceededError(Exception):
+    '''raised when the daily request limit of the API is used up'''
+    pass
+
+class SearchFailedError(Exception):
+    '''raised when the API answers a page of a search with an error'''
+    pass
+
+class TokenBucket:
+    '''a token bucket limiting upstream requests of all threads to a
+    sustained rate, a burst size and a daily quota
+
+    With a database, the requests of the day are counted in its Meta
+    table under a key holding the date, so the quota holds across runs
+    and processes sharing the database.
+
+    Instance Attributes
+    -------------------
+    rate: float
+        tokens added per second, the sustained requests per second
+
+    capacity: float
+        the maximum number of tokens, the largest burst of requests
+
+    tokens: float
+        the tokens currently available
+
+    daily_limit: integer
+        the maximum number of requests per calendar day
+
+    day: string
+        the current day (e.g. 2020-04-20)
+
+    day_count: integer
+        the number of requests made on the current day
+
+    conn: Connection
+        the connection to the database keeping day_count, None to keep it
+        in memory only
+
+    lock: Lock
+        guards the counters and conn
+    '''
+    def __init__(self, rate=API_MAX_QPS, capacity=API_BURST, daily_limit=API_DAILY_LIMIT, db_name=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.daily_limit = daily_limit
+        self.day = time.strftime('%Y-%m-%d')
+        self.lock = threading.Lock()
+        self.conn = None
+        if db_name is not None:
+            self.conn = final_proj_db.connect(db_name, check_same_thread=False)
+            self.conn.execute(META_TABLE_STATEMENT)
+        self.day_count = self.load_day_count()
+
+    def load_day_count(self):
+        ''' Read the number of requests made on the current day, dropping
+        the counts of earlier days.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        integer
+            the stored count, 0 without a database
+        '''
+        if self.conn is None:
+            return 0
+        sql_statement = '''
+            DELETE FROM Meta WHERE Meta.key LIKE 'api_requests_%' AND Meta.key != ?
+        '''
+        self.conn.execute(sql_statement, ['api_requests_' + self.day])
+        self.conn.commit()
+        row = self.conn.execute('SELECT Meta.value FROM Meta WHERE Meta.key = ?', ['api_requests_' + self.day]).fetchone()
+        return 0 if row is None else int(row[0])
+
+    def count_request(self):
+        ''' Count a request of the current day, in the database when there
+        is one, so requests of other processes are included.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        integer
+            the number of requests made on the current day
+        '''
+        if self.conn is None:
+            return self.day_count + 1
+        sql_statement = '''
+            INSERT INTO Meta VALUES (?, '1')
+            ON CONFLICT("key") DO UPDATE SET value = CAST(Meta.value AS INTEGER) + 1
+        '''
+        self.conn.execute(sql_statement, ['api_requests_' + self.day])
+        self.conn.commit()
+        row = self.conn.execute('SELECT Meta.value FROM Meta WHERE Meta.key = ?', ['api_requests_' + self.day]).fetchone()
+        return int(row[0])
+
+    def acquire(self):
+        ''' Block until a token is available and take it.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        None
+        '''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                today = time.strftime('%Y-%m-%d')
+                if today != self.day:
+                    self.day = today
+                    self.day_count = self.load_day_count()
+                if self.day_count >= self.daily_limit:
+                    raise QuotaExceededError('The daily limit of ' + str(self.daily_limit) + ' requests is used up.')
+                if self.tokens >= 1:
+                    self.day_count = self.count_request()
+                    if self.day_count > self.daily_limit:
+                        raise QuotaExceededError('The daily limit of ' + str(self.daily_limit) + ' requests is used up.')
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+class LatencyHistogram:
+    '''a histogram of request latencies of one endpoint
+
+    Instance Attributes
+    -------------------
+    counts: list
+        the number of requests per bucket of LATENCY_BUCKETS_MS, the last
+        bucket holds everything slower
+
+    total_ms: float
+        the sum of all latencies
+
+    max_ms: float
+        the slowest latency seen
+    '''
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, latency_ms):
+        ''' Record one latency.
+
+        Parameters
+        ----------
+        latency_ms: float
+            the latency of a request in milliseconds
+
+        Returns
+        -------
+        None
+        '''
+        bucket = len(LATENCY_BUCKETS_MS)
+        for bucket_pos, bound in enumerate(LATENCY_BUCKETS_MS):
+            if latency_ms <= bound:
+                bucket = bucket_pos
+                break
+        self.counts[bucket] += 1
+        self.total_ms += latency_ms
+        self.max_ms = max(self.max_ms, latency_ms)
+
+    def percentile(self, fraction):
+        ''' Estimate a percentile as the upper bound of its bucket.
+
+        Parameters
+        ----------
+        fraction: float
+            the percentile as a fraction (e.g. 0.99)
+
+        Returns
+        -------
+        float
+            the latency in milliseconds
+        '''
+        target = fraction * sum(self.counts)
+        seen = 0
+        for bucket_pos, count in enumerate(self.counts):
+            seen += count
+            if count > 0 and seen >= target:
+                if bucket_pos < len(LATENCY_BUCKETS_MS):
+                    return min(LATENCY_BUCKETS_MS[bucket_pos], self.max_ms)
+                return self.max_ms
+        return 0.0
+
+def record_latency(url, latency_ms):
+    ''' Add a latency to the histogram of the url's endpoint.
+
+    Parameters
+    ----------
+    url: string
+        the requested url, its query string is ignored
+
+    latency_ms: float
+        the latency of the request in milliseconds
+
+    Returns
+    -------
+    None
+    '''
+    url_parts = urlsplit(url)
+    endpoint = url_parts.netloc + url_parts.path
+    with LATENCY_HISTOGRAMS_LOCK:
+        if endpoint not in LATENCY_HISTOGRAMS:
+            LATENCY_HISTOGRAMS[endpoint] = LatencyHistogram()
+        LATENCY_HISTOGRAMS[endpoint].add(latency_ms)
+
+def print_latency_histograms():
+    ''' Print the latency histogram of every requested endpoint.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
+    '''
+    with LATENCY_HISTOGRAMS_LOCK:
+        histogram_items = sorted(LATENCY_HISTOGRAMS.items())
+    for endpoint, histogram in histogram_items:
+        request_count = sum(histogram.counts)
+        print('{}: {} requests, mean={:0.0f} ms, p50<={:0.0f} ms, p99<={:0.0f} ms, max={:0.0f} ms'.format(
+            endpoint, request_count, histogram.total_ms / request_count,
+            histogram.percentile(0.5), histogram.percentile(0.99), histogram.max_ms))
+        labels = ['<=' + str(bound) + 'ms' for bound in LATENCY_BUCKETS_MS] + ['>' + str(LATENCY_BUCKETS_MS[-1]) + 'ms']
+        print('    ' + '  '.join(label + ':' + str(count) for label, count in zip(labels, histogram.counts)))
+
+class SingleFlight:
+    '''a registry of in-flight upstream requests, so concurrent callers
+    asking for the same key wait on one request and share its result
+
+    Instance Attributes
+    -------------------
+    calls: dict
+        key is a request key and value is [event, result, error] of the
+        request in flight
+
+    upstream_count: integer
+        the number of requests actually made
+
+    coalesced_count: integer
+        the number of callers served by another caller's request, the
+        upstream calls saved
+
+    lock: Lock
+        guards calls and the counters
+    '''
+    def __init__(self):
+        self.calls = {}
+        self.upstream_count = 0
+        self.coalesced_count = 0
+        self.lock = threading.Lock()
+
+    def do(self, key, function):
+        ''' Run function for a key unless the same key is already in
+        flight, in which case wait for that call and return its result.
+
+        Parameters
+        ----------
+        key: string
+            the request key
+
+        function: function
+            makes the request, called without arguments
+
+        Returns
+        -------
+        object
+            the result of the request; its exception is raised to every
+            waiting caller
+        '''
+        with self.lock:
+            call = self.calls.get(key)
+            if call is None:
+                call = [threading.Event(), None, None]
+                self.calls[key] = call
+                self.upstream_count += 1
+                leader = True
+            else:
+                self.coalesced_count += 1
+                leader = False
+
+        if not leader:
+            call[0].wait()
+        else:
+            try:
+                call[1] = function()
+            except Exception as error:
+                call[2] = error
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call[0].set()
+        if call[2] is not None:
+            raise call[2]
+        return call[1]
+
+    def stats(self):
+        ''' Report the request counters.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        dict
+            the number of 'upstream' requests made and of 'coalesced' callers
+        '''
+        with self.lock:
+            return {'upstream': self.upstream_count, 'coalesced': self.coalesced_count}
+
+def get_single_flight():
+    ''' Get the in-flight request registry shared by every thread.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    SingleFlight
+        the shared registry
+    '''
+    global SINGLE_FLIGHT
+    if SINGLE_FLIGHT is None:
+        with SINGLE_FLIGHT_LOCK:
+            if SINGLE_FLIGHT is None:
+                SINGLE_FLIGHT = SingleFlight()
+    return SINGLE_FLIGHT
+
+def get_token_bucket():
+    ''' Get the token bucket shared by every upstream request.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    TokenBucket
+        the shared token bucket
+    '''
+    global TOKEN_BUCKET
+    if TOKEN_BUCKET is None:
+        with TOKEN_BUCKET_LOCK:
+            if TOKEN_BUCKET is None:
+                TOKEN_BUCKET = TokenBucket(db_name=DBNAME)
+    return TOKEN_BUCKET
+
+def get_http_session():
+    ''' Get the connection-pooled http session shared by every request.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    Session
+        the shared requests session
+    '''
+    import requests
+    global HTTP_SESSION
+    if HTTP_SESSION is None:
+        with HTTP_SESSION_LOCK:
+            if HTTP_SESSION is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                HTTP_SESSION = session
+    return HTTP_SESSION
 
-        # Insert data into database
-        sql_statement_drop = '''
-            DROP TABLE IF EXISTS "Business"
-        '''
-        cur.execute(sql_statement_drop)
-        
-        sql_statement_creat = '''
-            CREATE TABLE IF NOT EXISTS "Business" (
-            "id"	INTEGER,
-            "yelp_id"	TEXT NOT NULL,
-            "alias"	TEXT,
-            "name"	TEXT NOT NULL,
-            "url"	TEXT,
-            "review_count"	INTEGER,
-            "category_1"	TEXT,
-            "category_2"	TEXT,
-            "category_3"	TEXT,
-            "rating"	REAL,
-            "price_level"	INTEGER,
-            "location_zip_code"	TEXT,
-            "location_city"	TEXT,
-            "location_state"	TEXT,
-            "location_country"	INTEGER,
-            "location_display_address"	TEXT,
-            "display_phone"	TEXT,
-            "recommendation_score"	REAL,
-            PRIMARY KEY("Id" AUTOINCREMENT)
-        )
-        '''
-        cur.execute(sql_statement_creat)
+def get_retry_delay(response, attempt):
+    ''' Decide how long to wait before retrying a failed request.
 
-        for instance in business_instance_list:
+    Parameters
+    ----------
+    response: Response
+        the failed response, None if the connection failed
 
-            v1 = instance.id
-            try:
-                v2 = instance.alias
-            except:
-                v2 = 'Null'
-            try:
-                v3 = instance.name
-            except:
-                v3 = 'Null'
-            try:
-                v4 = instance.url
-            except:
-                v4 = 'Null'
-            try:
-                v5 = instance.review_count
-            except:
-                v5 = 0
-            try:
-                v6 = instance.category_title_list[0]
-            except:
-                v6 = 'Null'
-            try:
-                v7 = instance.category_title_list[1]
-            except:
-                v7 = 'Null'
-            try:
-                v8 = instance.category_title_list[2]
-            except:
-                v8 = 'Null'
-            try:
-                v9 = instance.rating
-            except:
-                v9 = 0.0
-            try:
-                v10 = instance.price_level
-            except:
-                v10 = 6
-            try:
-                v11 = instance.location_zip_code
-            except:
-                v11 = 'Null'
-            try:
-                v12 = instance.location_city
-            except:
-                v12 = 'Null'
-            try:
-                v13 = instance.location_state
-            except:
-                v13 = 'Null'
-            try:
-                # v14 is a foreign key referred to Locale.country
-                v14 = instance.location_country
-                sql_statement_country = '''
-                    SELECT Locale.aplha2 FROM Locale
-                '''
-                res = cur.execute(sql_statement_country).fetchall()
-                for r in res:
-                    if v14 in r:
-                        v14 = res.index(r) + 1
-            except:
-                v14 = 12
-            try:
-                v15 = ''
-                for address in instance.location_display_address_list:
-                    v15 = v15 + address + ' '
-                v15 = v15.strip()
-            except:
-                v15 = 'Null'
-            try:
-                v16 = instance.display_phone
-            except:
-                v16 = 'Null'
-            v17 = 0.0
-            
-            sql_statement = '''
-            INSERT OR IGNORE INTO Business
-            VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            '''
+    attempt: integer
+        the number of attempts made so far, starting at 1
 
-            business_instance_value = [
-                v1, v2, v3, v4,
-                v5, v6, v7, v8,
-                v9, v10, v11, v12,
-                v13, v14, v15, v16, v17
-                ]
-            cur.execute(sql_statement, business_instance_value)
-            conn.commit()
+    Returns
+    -------
+    float
+        seconds to wait, the Retry-After header if the server sent one,
+        exponential backoff with full jitter otherwise
+    '''
+    if response is not None:
+        try:
+            return min(float(response.headers.get('Retry-After')), HTTP_BACKOFF_MAX)
+        except (TypeError, ValueError):
+            pass
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * 2 ** attempt))
 
-        return business_instance_list
+def http_get(url, headers=None):
+    ''' Send a GET request through the shared session under the token
+    bucket, retrying 429 and 5xx responses and connection errors.
 
-def load_cache():
-    '''Loading cache file if it exists or set up a new one if not.
-    
     Parameters
     ----------
-    None
-    
+    url: string
+        a url to be requested upon
+
+    headers: dict
+        extra request headers
+
     Returns
     -------
-    dict
-        a cache dictionary
+    Response
+        the last response received
     '''
-    try:
-        cache_file = open('cache_final_proj.json', 'r')
-        cache_file_contents = cache_file.read()
-        cache = json.loads(cache_file_contents)
-        cache_file.close()
-    except:
-        cache = {}
-    return cache
+    import requests
+    session = get_http_session()
+    for attempt in range(1, HTTP_MAX_RETRIES + 1):
+        get_token_bucket().acquire()
+        start_time = time.perf_counter()
+        try:
+            response = session.get(url, headers=headers, timeout=HTTP_TIMEOUT)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == HTTP_MAX_RETRIES:
+                raise
+            response = None
+        record_latency(url, (time.perf_counter() - start_time) * 1000)
+
+        if response is not None and response.status_code != 429 and response.status_code < 500:
+            return response
+        if attempt == HTTP_MAX_RETRIES:
+            return response
+        delay = get_retry_delay(response, attempt)
+        if VERBOSE:
+            sys.stdout.write('Retrying in {:0.1f} s: {}\n'.format(delay, url))
+        time.sleep(delay)
+
+def print_banner(text):
+    ''' Print a message framed by dashes unless VERBOSE is off. The banner
+    is written at once, so banners of pages fetched on other threads do
+    not interleave with it.
 
-def save_cache(cache):
-    '''Saving cache file.
-    
     Parameters
     ----------
-    cache: dictionary
-        a dictionary to be written into the cache file
-    
+    text: string
+        the message
+
     Returns
     -------
     None
     '''
-    cache_file = open('cache_final_proj.json', 'w')
-    contents_to_write = json.dumps(cache)
-    cache_file.write(contents_to_write)
-    cache_file.close()
+    if VERBOSE:
+        rule = '-' * len(text)
+        sys.stdout.write(rule + '\n' + text + '\n' + rule + '\n')
 
 def make_url_request_using_cache(url, cache):
     '''Making a url request using cache.
@@ -1136,30 +4287,22 @@ def make_url_request_using_cache(url, cache):
     url: string
         a url to be requested upon
     
-    cache: dictionary
-        a dictionary with visited urls as keys and responses as values 
+    cache: TieredCache
+        a cache store with visited urls as keys and responses as values 
     
     Returns
     -------
-    string
-        a url string made with cache
-    '''
-    # database_inserted_flag = True
-    if (url in cache.keys()):
-        print('-' * len("Using cache: " + url))
-        print("Using cache: " + url)
-        print('-' * len("Using cache: " + url))
-        return cache[url] #, database_inserted_flag
+    dict
+        the json response of the url, with an 'error' entry if the api
+        answered with an error
+    '''
+    cache_key = get_cache_key(url)
+    response = cache.get(cache_key)
+    if response is not None and response.get('schema', SEARCH_PROJECTION_VERSION) == SEARCH_PROJECTION_VERSION:
+        print_banner("Using cache: " + url)
+        return response
     else:
-        print('-' * len("Fetching: " + url))
-        print("Fetching: " + url)
-        print('-' * len("Fetching: " + url))
-        time.sleep(1)
-        response = requests.get(url, headers=headers)
-        cache[url] = response.json()
-        save_cache(cache)
-        # database_inserted_flag = False # we need to insert data to db
-        return cache[url] #, database_inserted_flag
+        return get_single_flight().do(cache_key, lambda: fetch_url_into_cache(url, cache_key, cache, False))
 
 def make_url_request_using_cache_html(url, cache):
     '''Making a url request using cache.
@@ -1169,28 +4312,607 @@ def make_url_request_using_cache_html(url, cache):
     url: string
         a url to be requested upon
     
-    cache: dictionary
-        a dictionary with visited urls as keys and responses as values 
+    cache: TieredCache
+        a cache store with visited urls as keys and responses as values 
     
     Returns
     -------
     string
-        a url string made with cache
+        the html text of the url
     '''
-    if (url in cache.keys()):
-        print('-' * len("Using cache: " + url))
-        print("Using cache: " + url)
-        print('-' * len("Using cache: " + url))
-        return cache[url]
+    cache_key = get_cache_key(url)
+    response = cache.get(cache_key)
+    if response is not None:
+        print_banner("Using cache: " + url)
+        return response
     else:
-        print('-' * len("Fetching: " + url))
-        print("Fetching: " + url)
-        print('-' * len("Fetching: " + url))
-        time.sleep(1)
-        response = requests.get(url)
-        cache[url] = response.text
-        save_cache(cache)
-        return cache[url]
+        return get_single_flight().do(cache_key, lambda: fetch_url_into_cache(url, cache_key, cache, True))
+
+def get_response_payload(response):
+    ''' Read the json payload of an api response, giving every error
+    response an 'error' entry even when its body is not json.
+
+    Parameters
+    ----------
+    response: Response
+        a response of the api
+
+    Returns
+    -------
+    dict
+        the json payload of the response
+    '''
+    try:
+        payload = response.json()
+    except ValueError:
+        payload = None
+    if not isinstance(payload, dict):
+        payload = {}
+    if response.status_code >= 400 and 'error' not in payload:
+        payload['error'] = {'code': 'HTTP_' + str(response.status_code), 'description': response.reason}
+    return payload
+
+def get_response_class(status_code, payload):
+    ''' Classify an api response to choose how long it is cached, see
+    RESPONSE_CLASS_TTLS.
+
+    Parameters
+    ----------
+    status_code: integer
+        the http status code of the response
+
+    payload: dict
+        the json payload of the response
+
+    Returns
+    -------
+    string
+        'success', 'empty', 'client_error', 'auth_error', 'rate_limited'
+        or 'server_error'
+    '''
+    if status_code == 429:
+        return 'rate_limited'
+    if status_code >= 500:
+        return 'server_error'
+    if status_code in (401, 403):
+        return 'auth_error'
+    if status_code >= 400:
+        return 'client_error'
+    if get_response_business_count(payload) == 0:
+        return 'empty'
+    return 'success'
+
+def get_legacy_response_ttl(value):
+    ''' Choose how long an entry of the legacy json cache stays valid. The
+    legacy cache kept no status codes, so html pages get HTML_CACHE_TTL,
+    error payloads are dropped and search responses are classified by
+    their content, see RESPONSE_CLASS_TTLS.
+
+    Parameters
+    ----------
+    value: object
+        a response of the legacy json cache
+
+    Returns
+    -------
+    integer
+        seconds the entry stays valid, 0 if it should not be kept
+    '''
+    if isinstance(value, str):
+        return HTML_CACHE_TTL
+    if not isinstance(value, dict) or 'error' in value:
+        return 0
+    return RESPONSE_CLASS_TTLS[get_response_class(200, value)]
+
+def fetch_url_into_cache(url, cache_key, cache, html):
+    ''' Request a url upstream and cache its response; called by one
+    caller per url at a time through the in-flight registry.
+
+    The cache is peeked at again first, since a request for the same url
+    may have finished between the caller's miss and its turn; the peek is
+    not counted, the caller's lookup already counted the miss.
+
+    Parameters
+    ----------
+    url: string
+        a url to be requested upon
+
+    cache_key: string
+        the canonical cache key of the url
+
+    cache: TieredCache
+        a cache store with visited urls as keys and responses as values
+
+    html: boolean
+        True for a html page, False for a json api response
+
+    Returns
+    -------
+    object
+        the html text or the json response of the url; errors are
+        returned as a json response with an 'error' entry
+    '''
+    response = cache.peek(cache_key)
+    if response is not None and (html or response.get('schema', SEARCH_PROJECTION_VERSION) == SEARCH_PROJECTION_VERSION):
+        return response
+
+    print_banner("Fetching: " + url)
+    if html:
+        response = http_get(url)
+        if response.status_code < 400:
+            cache.set(cache_key, response.text, HTML_CACHE_TTL)
+        return response.text
+
+    response = http_get(url, headers=headers)
+    payload = get_response_payload(response)
+    ttl = RESPONSE_CLASS_TTLS[get_response_class(response.status_code, payload)]
+    payload = project_search_response(payload)
+    if ttl > 0:
+        cache.set(cache_key, payload, ttl)
+    return payload
+
+def create_batch_tables():
+    ''' Create the tables of batch mode.
+
+    BatchJob is the checkpoint of a batch: a job whose row says 'done' is
+    skipped when the batch is run again. BatchResult holds the full
+    ranking of every finished job.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
+    '''
+    sql_statement = '''
+        CREATE TABLE IF NOT EXISTS "BatchJob" (
+        "job_id"	TEXT NOT NULL,
+        "url"	TEXT,
+        "weights"	TEXT,
+        "status"	TEXT NOT NULL,
+        "latency_ms"	REAL,
+        "finished_at"	REAL NOT NULL,
+        PRIMARY KEY("job_id")
+    ) WITHOUT ROWID
+    '''
+    get_cursor().execute(sql_statement)
+
+    sql_statement = '''
+        CREATE TABLE IF NOT EXISTS "BatchResult" (
+        "job_id"	TEXT NOT NULL,
+        "rank"	INTEGER NOT NULL,
+        "business_id"	INTEGER NOT NULL,
+        "recommendation_score"	REAL,
+        PRIMARY KEY("job_id", "rank")
+    ) WITHOUT ROWID
+    '''
+    get_cursor().execute(sql_statement)
+    get_connection().commit()
+
+def get_batch_job_id(job):
+    ''' Identify a batch job by its content, so reruns of a job file find
+    their checkpoints.
+
+    Parameters
+    ----------
+    job: dict
+        a batch job
+
+    Returns
+    -------
+    string
+        the sha1 of the job
+    '''
+    return hashlib.sha1(json.dumps(job, sort_keys=True).encode('utf-8')).hexdigest()
+
+def get_job_weights(job):
+    ''' Read the weights of a job.
+
+    Parameters
+    ----------
+    job: dict
+        a job with a 'weights' dict keyed by care column
+
+    Returns
+    -------
+    tuple
+        weights in CARE_COLUMNS order
+    '''
+    return tuple(float(job['weights'][column]) for column in CARE_COLUMNS)
+
+def get_percentile(sorted_values, fraction):
+    ''' Pick a percentile of sorted values.
+
+    Parameters
+    ----------
+    sorted_values: list
+        values in ascending order, not empty
+
+    fraction: float
+        the percentile as a fraction (e.g. 0.99)
+
+    Returns
+    -------
+    float
+        the value at the percentile
+    '''
+    return sorted_values[int(fraction * (len(sorted_values) - 1))]
+
+def get_batch_search_url(job):
+    ''' Resolve the country, city and category of a batch job to the url
+    of its search, the way the prompts would.
+
+    An unknown category is replaced by its best fuzzy match in the country.
+
+    Parameters
+    ----------
+    job: dict
+        a batch job
+
+    Returns
+    -------
+    string
+        the url of the first page of the search
+    '''
+    locale_code_dict = get_locale_code()
+    country_input = job['country'].lower().replace(' ', '')
+    if country_input not in locale_code_dict:
+        raise ValueError('unknown country ' + job['country'])
+    country_locale_code = locale_code_dict[country_input]
+    alpha2 = country_locale_code.split('_')[1]
+
+    category = job['category'].strip().lower()
+    if category not in get_categories_list(alpha2):
+        matches = get_category_index(alpha2).search(category)
+        if len(matches) == 0:
+            raise ValueError('unknown category ' + job['category'])
+        category = matches[0][1]
+
+    url_pieces = 'locale=' + country_locale_code + '&location=' + job['city'].lower().replace(' ', '')
+    return get_search_url(url_pieces, get_category_descendants(category, alpha2))
+
+def precompute_search(page_list, business_instance_list, weights_list):
+    ''' Parse the pages of a search and rank it under several weight
+    vectors. Runs on a worker process, so it touches neither the database
+    nor the cache.
+
+    A search whose pages hold an error response, or lack a page its first
+    page announced, raises SearchFailedError so its jobs are not ranked on
+    partial results.
+
+    Parameters
+    ----------
+    page_list: list
+        (offset, json response) tuples of a fetched search, empty for a
+        search already in the store
+
+    business_instance_list: list
+        the business instances of a search already in the store
+
+    weights_list: list
+        weight tuples in CARE_COLUMNS order
+
+    Returns
+    -------
+    list
+        (offset, business instances) tuples of the parsed pages
+
+    list
+        one ranking of (yelp id, score) tuples per weight vector, best first
+
+    float
+        the time the worker spent on the search in milliseconds
+    '''
+    start_time = time.perf_counter()
+    page_list = sorted(page_list, key=lambda page: page[0])
+    for offset, business_response in page_list:
+        check_search_response(business_response)
+    if len(page_list) > 0:
+        if page_list[0][0] == 0:
+            missing_offsets = set(get_search_offsets(page_list[0][1])) - set(offset for offset, business_response in page_list)
+        else:
+            missing_offsets = set([0])
+        if len(missing_offsets) > 0:
+            raise SearchFailedError('pages at offsets ' + str(sorted(missing_offsets)) + ' were not fetched')
+
+    page_instance_list = []
+    business_instance_list = list(business_instance_list)
+    for offset, business_response in page_list:
+        page_instance_list.append((offset, get_page_business_instance_list(business_response)))
+        business_instance_list.extend(page_instance_list[-1][1])
+
+    score_rows = []
+    seen = set()
+    for instance in business_instance_list:
+        if instance.id not in seen:
+            seen.add(instance.id)
+            score_rows.append((instance.id, instance.price_level, instance.rating, instance.review_count))
+    score_matrix = ScoreMatrix(score_rows)
+    ranking_list = [score_matrix.rank(weights) for weights in weights_list]
+    return page_instance_list, ranking_list, (time.perf_counter() - start_time) * 1000
+
+def fetch_batch_search(url_category):
+    ''' Fetch every page of a search of a batch on a fetch thread, timing
+    the fetch itself rather than the time the search waited for a thread.
+
+    Parameters
+    ----------
+    url_category: string
+        the url of the first page of the search
+
+    Returns
+    -------
+    list
+        a list of (offset, json response) tuples
+
+    float
+        the time the fetch took in milliseconds
+    '''
+    start_time = time.perf_counter()
+    page_list = fetch_search_response_pages(url_category)
+    return page_list, (time.perf_counter() - start_time) * 1000
+
+def set_batch_job_status(job_id, url_category, weights, status, latency_ms=None):
+    ''' Record the outcome of a batch job and commit it as a checkpoint.
+
+    Parameters
+    ----------
+    job_id: string
+        the id of the job
+
+    url_category: string
+        the url of the search of the job, None if it could not be resolved
+
+    weights: tuple
+        weights in CARE_COLUMNS order, None if they could not be read
+
+    status: string
+        'done' or 'failed'
+
+    latency_ms: float
+        the time the job took
+
+    Returns
+    -------
+    None
+    '''
+    if weights is not None:
+        weights = json.dumps(dict(zip(CARE_COLUMNS, weights)))
+    sql_statement = '''
+    INSERT OR REPLACE INTO BatchJob
+    VALUES (?, ?, ?, ?, ?, ?)
+    '''
+    get_cursor().execute(sql_statement, [job_id, url_category, weights, status, latency_ms, time.time()])
+    get_connection().commit()
+
+def store_batch_result(job_id, url_category, weights, ranking, latency_ms):
+    ''' Write the ranking of a finished batch job and its checkpoint in one
+    transaction.
+
+    Parameters
+    ----------
+    job_id: string
+        the id of the job
+
+    url_category: string
+        the url of the search of the job
+
+    weights: tuple
+        weights in CARE_COLUMNS order
+
+    ranking: list
+        (yelp id, score) tuples, best first
+
+    latency_ms: float
+        the time the job took
+
+    Returns
+    -------
+    None
+    '''
+    get_cursor().execute('DELETE FROM BatchResult WHERE BatchResult.job_id = ?', [job_id])
+    sql_statement = '''
+    INSERT INTO BatchResult
+    SELECT ?, ?, Business.id, ? FROM Business WHERE Business.yelp_id = ?
+    '''
+    get_cursor().executemany(sql_statement, [[job_id, rank, score, yelp_id] for rank, (yelp_id, score) in enumerate(ranking)])
+    set_batch_job_status(job_id, url_category, weights, 'done', latency_ms)
+
+def run_batch(job_filename, workers=BATCH_WORKERS):
+    ''' Precompute the recommendations of a file of jobs without prompting.
+
+    Every line of the file is a json job such as
+    {"country": "united states", "city": "Ann Arbor", "category": "chinese",
+    "weights": {"price_level": 0.1, "rating": 0.3, "review_count": 0.6}}.
+    Jobs sharing a search are fetched once; searches are fetched on a
+    thread pool, parsed and scored on a pool of worker processes, and
+    stored on the calling process as soon as each one is scored. The latency
+    of a job is the time its search spent being fetched, scored and stored,
+    not the time it waited for a free worker. Every finished job is
+    checkpointed, so running the same file again after a crash resumes
+    where it stopped.
+    Jobs whose search failed upstream are checkpointed as 'failed' and
+    run again with the next batch.
+
+    Parameters
+    ----------
+    job_filename: string
+        the path of the job file
+
+    workers: integer
+        the number of worker processes
+
+    Returns
+    -------
+    dict
+        the number of jobs 'done', 'failed' and 'skipped' as already done
+    '''
+    import requests
+    from concurrent.futures import ProcessPoolExecutor
+    start_time = time.perf_counter()
+    create_business_tables()
+    create_batch_tables()
+    with open(job_filename) as f:
+        job_list = [json.loads(line) for line in f if line.strip() != '']
+
+    done_ids = set(row[0] for row in get_cursor().execute("SELECT BatchJob.job_id FROM BatchJob WHERE BatchJob.status = 'done'"))
+    summary = {'done': 0, 'failed': 0, 'skipped': 0}
+    url_job_dict = {}
+    for job in job_list:
+        job_id = get_batch_job_id(job)
+        if job_id in done_ids:
+            summary['skipped'] += 1
+            continue
+        try:
+            url_category = get_batch_search_url(job)
+            weights = get_job_weights(job)
+        except (KeyError, TypeError, ValueError) as error:
+            if isinstance(error, KeyError):
+                error = 'missing ' + str(error)
+            print('Job ' + job_id[:8] + ' failed: ' + str(error))
+            set_batch_job_status(job_id, None, None, 'failed')
+            summary['failed'] += 1
+            continue
+        url_job_dict.setdefault(url_category, {})[job_id] = weights
+
+    job_count = sum(len(job_dict) for job_dict in url_job_dict.values())
+    print('Batch: {} jobs, {} already done, {} searches to precompute.'.format(
+        len(job_list), summary['skipped'], len(url_job_dict)))
+
+    url_elapsed_dict = {}
+    job_latencies = []
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as fetch_executor, \
+            ProcessPoolExecutor(max_workers=workers) as process_executor:
+        fetch_future_dict = {}
+        process_future_dict = {}
+        for url_category, job_dict in url_job_dict.items():
+            search_id = get_search_id(url_category)
+            if search_id is not None:
+                load_start_time = time.perf_counter()
+                business_instance_list = get_stored_business_instance_list(search_id)
+                url_elapsed_dict[url_category] = (time.perf_counter() - load_start_time) * 1000
+                future = process_executor.submit(precompute_search, [],
+                    business_instance_list, list(job_dict.values()))
+                process_future_dict[future] = url_category
+            else:
+                fetch_future_dict[fetch_executor.submit(fetch_batch_search, url_category)] = url_category
+
+        # searches are precomputed and stored while other searches are still fetched
+        pending = set(fetch_future_dict) | set(process_future_dict)
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in fetch_future_dict:
+                    url_category = fetch_future_dict[future]
+                    try:
+                        page_list, url_elapsed_dict[url_category] = future.result()
+                    except (requests.RequestException, QuotaExceededError, SearchFailedError) as error:
+                        print('Fetching ' + url_category + ' failed: ' + str(error))
+                        for job_id, weights in url_job_dict[url_category].items():
+                            set_batch_job_status(job_id, url_category, weights, 'failed')
+                            summary['failed'] += 1
+                        continue
+                    future = process_executor.submit(precompute_search, page_list, [],
+                        list(url_job_dict[url_category].values()))
+                    process_future_dict[future] = url_category
+                    pending.add(future)
+                    continue
+
+                url_category = process_future_dict[future]
+                try:
+                    page_instance_list, ranking_list, precompute_ms = future.result()
+                except SearchFailedError as error:
+                    print('Precomputing ' + url_category + ' failed: ' + str(error))
+                    for job_id, weights in url_job_dict[url_category].items():
+                        set_batch_job_status(job_id, url_category, weights, 'failed')
+                        summary['failed'] += 1
+                    continue
+                store_start_time = time.perf_counter()
+                business_instance_list = []
+                for offset, page_business_instance_list in page_instance_list:
+                    business_instance_list.extend(page_business_instance_list)
+                if len(business_instance_list) > 0:
+                    store_business_instance_list(business_instance_list, url_category)
+                search_ms = url_elapsed_dict[url_category] + precompute_ms + (time.perf_counter() - store_start_time) * 1000
+
+                for (job_id, weights), ranking in zip(url_job_dict[url_category].items(), ranking_list):
+                    result_start_time = time.perf_counter()
+                    store_batch_result(job_id, url_category, weights, ranking, search_ms)
+                    latency_ms = search_ms + (time.perf_counter() - result_start_time) * 1000
+                    job_latencies.append(latency_ms)
+                    summary['done'] += 1
+                    print('[{}/{}] job {} done in {:0.0f} ms, {} businesses ranked'.format(
+                        summary['done'], job_count, job_id[:8], latency_ms, len(ranking)))
+
+    elapsed = time.perf_counter() - start_time
+    print('Batch finished in {:0.1f} s: {} done, {} failed, {} skipped ({:0.1f} jobs/s)'.format(
+        elapsed, summary['done'], summary['failed'], summary['skipped'],
+        summary['done'] / elapsed if elapsed > 0 else 0.0))
+    if len(job_latencies) > 0:
+        job_latencies.sort()
+        print('Job latency: p50 {:0.0f} ms, p99 {:0.0f} ms, max {:0.0f} ms'.format(
+            get_percentile(job_latencies, 0.5), get_percentile(job_latencies, 0.99), job_latencies[-1]))
+    return summary
+
+def benchmark_startup(budget_ms=STARTUP_BUDGET_MS, runs=5):
+    ''' Measure the cold import of the program with python -X importtime
+    in fresh interpreters and compare it with a budget.
+
+    The heaviest modules it imports are listed, and requests, bs4 and
+    plotly, which are only loaded on first use, are reported if an import
+    pulls them in at startup.
+
+    Parameters
+    ----------
+    budget_ms: float
+        the allowed median import time of the program in milliseconds
+
+    runs: integer
+        the number of fresh interpreters measured
+
+    Returns
+    -------
+    boolean
+        True if the median import time is within the budget
+    '''
+    import subprocess
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    module_name = os.path.splitext(os.path.basename(__file__))[0]
+    import_ms_list = []
+    child_ms_dict = {}
+    for run in range(runs):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module_name],
+            cwd=module_dir, capture_output=True, text=True, check=True)
+        children = []
+        for line in result.stderr.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            self_us, cumulative_us, name = line[len('import time:'):].split('|')
+            level = (len(name) - len(name.lstrip()) - 1) // 2
+            if level == 1:
+                children.append((name.strip(), int(cumulative_us) / 1000))
+            elif level == 0:
+                if name.strip() == module_name:
+                    import_ms_list.append(int(cumulative_us) / 1000)
+                    for child_name, child_ms in children:
+                        child_ms_dict.setdefault(child_name, []).append(child_ms)
+                children = []
+
+    import_ms_list.sort()
+    median_ms = import_ms_list[len(import_ms_list) // 2]
+    print('Startup: import {} median {:0.1f} ms, min {:0.1f} ms over {} runs (budget {} ms)'.format(
+        module_name, median_ms, import_ms_list[0], runs, budget_ms))
+    heaviest = sorted(child_ms_dict.items(), key=lambda item: sorted(item[1])[len(item[1]) // 2], reverse=True)
+    for child_name, child_ms in heaviest[:5]:
+        print('    {:32}{:0.1f} ms'.format(child_name, sorted(child_ms)[len(child_ms) // 2]))
+    for lazy_module in ['requests', 'bs4', 'plotly']:
+        if lazy_module in child_ms_dict:
+            print('    ' + lazy_module + ' is imported at startup, it should be loaded on first use')
+    within_budget = median_ms <= budget_ms
+    print('Within budget.' if within_budget else 'Over budget!')
+    return within_budget
 
 def load_help_text():
     ''' Load FinalProjHelp.txt
@@ -1233,13 +4955,50 @@ def interactive_prompt():
             continue
 
         if response == 'exit':
-            print('Bye. Have a nice day!')
-            quit()
+            exit_program()
+
+        if response == 'stats':
+            print_cache_stats()
+            print_latency_histograms()
+            continue
 
         if response == '':
             continue
 
-        process_input_country(response)
+        try:
+            process_input_country(response)
+        except Exception as error:
+            if not is_upstream_error(error):
+                raise
+            print('Search failed: ' + str(error))
+
+def is_upstream_error(error):
+    ''' Tell whether an exception means the API could not answer: a
+    failed search, a used up quota or a request that failed after its
+    retries. requests is not imported for the check, an error of requests
+    can only occur once it was.
+
+    Parameters
+    ----------
+    error: Exception
+        the raised exception
+
+    Returns
+    -------
+    boolean
+        True if the exception is an upstream failure
+    '''
+    if isinstance(error, (QuotaExceededError, SearchFailedError)):
+        return True
+    requests = sys.modules.get('requests')
+    return requests is not None and isinstance(error, requests.RequestException)
 
 if __name__ == "__main__":
-    interactive_prompt()
\ No newline at end of file
+    if len(sys.argv) == 3 and sys.argv[1] == '--batch':
+        run_batch(sys.argv[2])
+    elif len(sys.argv) == 2 and sys.argv[1] == '--startup-benchmark':
+        sys.exit(0 if benchmark_startup() else 1)
+    elif len(sys.argv) == 2 and sys.argv[1] == '--check-query-plans':
+        sys.exit(0 if check_query_plans() else 1)
+    else:
+        interactive_prompt()
\ No newline at end of file
@@ -0,0 +1,132 @@
+import sqlite3
+import threading
+
+DB_TIMEOUT = 10
+DB_PRAGMAS = [
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -16 * 1024),
+    ('mmap_size', 256 * 1024 * 1024),
+    ('temp_store', 'MEMORY'),
+    ('busy_timeout', DB_TIMEOUT * 1000),
+]
+STATEMENT_CACHE_SIZE = 256
+
+def connect(db_name, check_same_thread=True):
+    ''' Open a sqlite connection with the tuned pragmas of DB_PRAGMAS and a
+    statement cache of STATEMENT_CACHE_SIZE prepared statements.
+
+    Parameters
+    ----------
+    db_name: string
+        the path of the database
+
+    check_same_thread: boolean
+        False lets other threads use the connection, the caller then has
+        to serialize its use
+
+    Returns
+    -------
+    Connection
+        the sqlite connection
+    '''
+    connection = sqlite3.connect(db_name, timeout=DB_TIMEOUT, check_same_thread=check_same_thread,
+        cached_statements=STATEMENT_CACHE_SIZE)
+    for pragma, value in DB_PRAGMAS:
+        connection.execute('PRAGMA {}={}'.format(pragma, value))
+    return connection
+
+class ConnectionPool:
+    '''one sqlite connection and cursor per thread to a database, so
+    threads read and write concurrently under WAL instead of sharing one
+    connection
+
+    Instance Attributes
+    -------------------
+    db_name: string
+        the path of the database
+
+    connections: dict
+        key is a thread ident and value is its (connection, cursor) tuple
+
+    lock: Lock
+        guards connections
+    '''
+    def __init__(self, db_name):
+        self.db_name = db_name
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def get(self):
+        ''' Get the connection and cursor of the calling thread, opening
+        them on first use. Connections of finished threads are closed.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        tuple
+            the connection and the cursor of the calling thread
+        '''
+        ident = threading.get_ident()
+        entry = self.connections.get(ident)
+        if entry is not None:
+            return entry
+
+        # a thread ident can be reused once its thread is gone, so the
+        # connection is not bound to the thread that opened it
+        connection = connect(self.db_name, check_same_thread=False)
+        entry = (connection, connection.cursor())
+        with self.lock:
+            alive = set(thread.ident for thread in threading.enumerate())
+            for dead_ident in [key for key in self.connections if key not in alive]:
+                self.connections.pop(dead_ident)[0].close()
+            self.connections[ident] = entry
+        return entry
+
+    def get_connection(self):
+        ''' Get the connection of the calling thread.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        Connection
+            the connection of the calling thread
+        '''
+        return self.get()[0]
+
+    def get_cursor(self):
+        ''' Get the cursor of the calling thread.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        Cursor
+            the cursor of the calling thread
+        '''
+        return self.get()[1]
+
+    def close_all(self):
+        ''' Close the connections of every thread.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        None
+        '''
+        with self.lock:
+            entries = list(self.connections.values())
+            self.connections = {}
+        for connection, cursor in entries:
+            connection.close()
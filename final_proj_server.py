@@ -0,0 +1,549 @@
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer, ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+import requests
+import final_proj
+
+LOGGER = logging.getLogger('final_proj_server')
+SERVER_PORT = 8000
+SERVER_WORKERS = 16
+SERVER_LATENCY_WINDOW = 10000
+FAKE_UPSTREAM_LATENCY = 0.05
+FAKE_UPSTREAM_RESULTS = 120
+FAKE_UPSTREAM_EMPTY_CITY = 'Nowhere'
+FAKE_UPSTREAM_FAILING_CITY = 'Atlantis'
+FAKE_UPSTREAM_LOCALES = [
+    ('en_US', 'United States', 'English'),
+    ('en_CA', 'Canada', 'English'),
+    ('en_GB', 'United Kingdom', 'English'),
+    ('fr_FR', 'France', 'French'),
+]
+BENCHMARK_CITIES = ['Ann Arbor', 'Detroit', 'Chicago', 'Seattle', 'Boston', 'Austin']
+BENCHMARK_CATEGORIES = ['chinese', 'pizza']
+
+class RecommendationServer(HTTPServer):
+    '''an http server answering recommendation requests as json on a pool
+    of worker threads
+
+    Every request keeps its job, weights and ranking in local variables;
+    the response cache, the local store and the score matrices are shared.
+
+    Instance Attributes
+    -------------------
+    executor: ThreadPoolExecutor
+        the worker threads handling requests
+
+    ingest_flight: SingleFlight
+        lets concurrent requests for a search that is not stored yet wait
+        on one ingest
+
+    latencies: deque
+        the latencies of the latest requests in milliseconds
+
+    lock: Lock
+        guards latencies
+    '''
+    request_queue_size = 128
+
+    def __init__(self, server_address, workers=SERVER_WORKERS):
+        super().__init__(server_address, RecommendationRequestHandler)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.ingest_flight = final_proj.SingleFlight()
+        self.latencies = deque(maxlen=SERVER_LATENCY_WINDOW)
+        self.lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        ''' Hand a connection to a worker thread.
+
+        Parameters
+        ----------
+        request: socket
+            the connection of the client
+
+        client_address: tuple
+            the address of the client
+
+        Returns
+        -------
+        None
+        '''
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        ''' Answer a connection on a worker thread.
+
+        Parameters
+        ----------
+        request: socket
+            the connection of the client
+
+        client_address: tuple
+            the address of the client
+
+        Returns
+        -------
+        None
+        '''
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        ''' Stop accepting connections and wait for the workers.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        None
+        '''
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+    def handle_error(self, request, client_address):
+        ''' Log an unexpected error of a request instead of printing it.
+
+        Parameters
+        ----------
+        request: socket
+            the connection of the client
+
+        client_address: tuple
+            the address of the client
+
+        Returns
+        -------
+        None
+        '''
+        LOGGER.exception('Request from %s failed', client_address[0])
+
+    def record_latency(self, latency_ms):
+        ''' Record the latency of an answered request.
+
+        Parameters
+        ----------
+        latency_ms: float
+            the time the request took
+
+        Returns
+        -------
+        None
+        '''
+        with self.lock:
+            self.latencies.append(latency_ms)
+
+    def stats(self):
+        ''' Report latency percentiles of the latest requests together with
+        the cache and request coalescing counters.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        dict
+            the statistics of the server
+        '''
+        with self.lock:
+            latencies = sorted(self.latencies)
+        server_stats = {'requests': len(latencies)}
+        if len(latencies) > 0:
+            server_stats['p50_ms'] = final_proj.get_percentile(latencies, 0.5)
+            server_stats['p99_ms'] = final_proj.get_percentile(latencies, 0.99)
+            server_stats['max_ms'] = latencies[-1]
+        server_stats['cache'] = final_proj.load_cache().stats()
+        server_stats['flight'] = final_proj.get_single_flight().stats()
+        return server_stats
+
+class RecommendationRequestHandler(BaseHTTPRequestHandler):
+    '''answers POST /recommendations with a json job like the ones of batch
+    mode, plus an optional k, and GET /stats
+
+    A search that returned no restaurants is answered with 404, an error
+    response of the upstream with 502 and an unreachable upstream or a used
+    up quota with 503.'''
+    def do_POST(self):
+        start_time = time.perf_counter()
+        if urlsplit(self.path).path != '/recommendations':
+            self.send_json(404, {'error': 'unknown path ' + self.path})
+            return
+        try:
+            job = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            result = get_recommendations(job, self.server.ingest_flight,
+                int(job.get('k', final_proj.TOP_RECOMMENDATION_COUNT)))
+        except (KeyError, TypeError, ValueError, AttributeError) as error:
+            if isinstance(error, KeyError):
+                error = 'missing ' + str(error)
+            status, body = 400, {'error': str(error)}
+        except final_proj.SearchFailedError as error:
+            LOGGER.warning('Upstream search failed: %s', error)
+            status, body = 502, {'error': 'upstream search failed: ' + str(error)}
+        except (requests.RequestException, final_proj.QuotaExceededError) as error:
+            LOGGER.warning('Upstream unavailable: %s', error)
+            status, body = 503, {'error': str(error)}
+        else:
+            if result is None:
+                status, body = 404, {'error': 'no restaurants of this category found'}
+            else:
+                status, body = 200, result
+        self.send_json(status, body)
+        self.server.record_latency((time.perf_counter() - start_time) * 1000)
+
+    def do_GET(self):
+        if urlsplit(self.path).path == '/stats':
+            self.send_json(200, self.server.stats())
+        else:
+            self.send_json(404, {'error': 'unknown path ' + self.path})
+
+    def send_json(self, status, body):
+        ''' Send a json response.
+
+        Parameters
+        ----------
+        status: integer
+            the http status code
+
+        body: object
+            a json serializable response
+
+        Returns
+        -------
+        None
+        '''
+        body_bytes = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body_bytes)))
+        self.end_headers()
+        self.wfile.write(body_bytes)
+
+    def log_message(self, format, *args):
+        # latencies are collected in the server instead
+        pass
+
+def get_recommendations(job, ingest_flight, k=final_proj.TOP_RECOMMENDATION_COUNT):
+    ''' Rank the restaurants of a job without touching any state of other
+    requests: the scores are computed for this request and never written to
+    SearchResult.
+
+    Parameters
+    ----------
+    job: dict
+        country, city, category and weights, as in batch mode
+
+    ingest_flight: SingleFlight
+        coalesces concurrent ingests of the same search
+
+    k: integer
+        the number of recommendations
+
+    Returns
+    -------
+    dict
+        the resolved url, the weights and the ranked recommendations, None
+        if the search found no restaurants; a failed upstream search raises
+        SearchFailedError, RequestException or QuotaExceededError
+    '''
+    url_category = final_proj.get_batch_search_url(job)
+    weights = final_proj.get_job_weights(job)
+    search_id = ingest_flight.do(url_category, lambda: ingest_search(url_category))
+    if search_id is None:
+        return None
+
+    score_matrix = final_proj.get_score_matrix(search_id)
+    if weights in final_proj.get_weight_profiles():
+        ranking = score_matrix.top(weights, k)
+    else:
+        ranking = score_matrix.rank_uncached(weights, k)
+    business_dict = final_proj.get_business_detail_dict([business_id for business_id, score in ranking])
+
+    recommendations = []
+    for rank, (business_id, score) in enumerate(ranking, 1):
+        row = business_dict[business_id]
+        recommendations.append({
+            'rank': rank, 'name': row[1], 'score': score, 'review_count': row[2],
+            'price_level': row[3], 'rating': row[4], 'address': row[5], 'phone': row[6], 'city': row[7]})
+    return {
+        'url': url_category,
+        'weights': dict(zip(final_proj.CARE_COLUMNS, weights)),
+        'recommendations': recommendations,
+    }
+
+def ingest_search(url_category):
+    ''' Make sure a search is in the local store, fetching it if needed.
+
+    Parameters
+    ----------
+    url_category: string
+        the url of the search
+
+    Returns
+    -------
+    integer
+        the Id of the search in Search, None if it found nothing; upstream
+        failures are raised, so they are never taken for an empty search
+    '''
+    search_id = final_proj.get_search_id(url_category)
+    if search_id is None:
+        final_proj.get_business_instance_list(url_category)
+        search_id = final_proj.get_search_id(url_category)
+    return search_id
+
+def start_server(server_address, workers=SERVER_WORKERS):
+    ''' Load the locale and category tables, then start a recommendation
+    server on a background thread.
+
+    Parameters
+    ----------
+    server_address: tuple
+        the host and port to listen on, port 0 picks a free one
+
+    workers: integer
+        the number of worker threads
+
+    Returns
+    -------
+    RecommendationServer
+        the running server
+    '''
+    # the server reports through LOGGER and /stats, not the prints of the prompts
+    final_proj.VERBOSE = False
+    # every worker may fetch the pages of a search at once
+    final_proj.HTTP_POOL_SIZE = max(final_proj.HTTP_POOL_SIZE, workers * final_proj.FETCH_WORKERS)
+    # built once here, so concurrent first requests do not race to build them
+    final_proj.get_locale_code()
+    final_proj.get_category_rows()
+    final_proj.get_locale_id_dict()
+    final_proj.create_business_tables()
+
+    server = RecommendationServer(server_address, workers)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def serve(port=SERVER_PORT, workers=SERVER_WORKERS):
+    ''' Serve recommendations until interrupted, then log latency
+    percentiles.
+
+    Parameters
+    ----------
+    port: integer
+        the port to listen on
+
+    workers: integer
+        the number of worker threads
+
+    Returns
+    -------
+    None
+    '''
+    server = start_server(('', port), workers)
+    LOGGER.info('Serving recommendations on port %d (POST /recommendations, GET /stats)', port)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    server.shutdown()
+    server.server_close()
+    LOGGER.info('Server stopped: %s', json.dumps(server.stats()))
+
+class FakeUpstreamRequestHandler(BaseHTTPRequestHandler):
+    '''a local stand-in for yelp serving the locale page and generated
+    search results, for testing the server without an api key; searches in
+    FAKE_UPSTREAM_EMPTY_CITY find nothing and searches in
+    FAKE_UPSTREAM_FAILING_CITY fail'''
+    def do_GET(self):
+        time.sleep(FAKE_UPSTREAM_LATENCY)
+        url_parts = urlsplit(self.path)
+        status = 200
+        if url_parts.path.endswith('supported_locales'):
+            rows = ''.join('<tr><td>{}</td><td>{}</td><td>{}</td></tr>'.format(*locale) for locale in FAKE_UPSTREAM_LOCALES)
+            body = ('<table><tbody>' + rows + '</tbody></table>').encode('utf-8')
+            content_type = 'text/html'
+        else:
+            query = {name: values[0] for name, values in parse_qs(url_parts.query).items()}
+            if query.get('location') == FAKE_UPSTREAM_FAILING_CITY.lower().replace(' ', ''):
+                status = 400
+                search_response = {'error': {'code': 'LOCATION_NOT_FOUND', 'description': 'Could not execute search.'}}
+            else:
+                search_response = get_fake_search_response(query)
+            body = json.dumps(search_response).encode('utf-8')
+            content_type = 'application/json'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def get_fake_search_response(query):
+    ''' Generate a deterministic page of search results.
+
+    Parameters
+    ----------
+    query: dict
+        the query parameters of a search url
+
+    Returns
+    -------
+    dict
+        a search response shaped like yelp's
+    '''
+    location = query.get('location', '')
+    categories = query.get('categories', '')
+    offset = int(query.get('offset', 0))
+    limit = int(query.get('limit', 20))
+    search_key = hashlib.sha1((location + '|' + categories).encode('utf-8')).hexdigest()[:8]
+
+    total = FAKE_UPSTREAM_RESULTS
+    if location == FAKE_UPSTREAM_EMPTY_CITY.lower().replace(' ', ''):
+        total = 0
+
+    businesses = []
+    for index in range(offset, min(offset + limit, total)):
+        rng = random.Random(search_key + str(index))
+        business = {
+            'id': search_key + '-' + str(index), 'alias': 'fake-' + search_key + '-' + str(index),
+            'name': 'Fake ' + location + ' ' + str(index), 'url': 'https://www.yelp.com/biz/fake',
+            'review_count': rng.randint(1, 3000), 'rating': rng.choice([2.5, 3.0, 3.5, 4.0, 4.5, 5.0]),
+            'categories': [{'alias': categories.split(',')[0], 'title': categories.split(',')[0].title()}],
+            'location': {'zip_code': '00000', 'city': location, 'state': 'XX', 'country': 'US',
+                'display_address': [str(index) + ' Main St', location]},
+            'display_phone': '(000) 555-{:04d}'.format(index),
+        }
+        if rng.random() < 0.9:
+            business['price'] = '$' * rng.randint(1, 4)
+        businesses.append(business)
+    return {'businesses': businesses, 'total': total}
+
+def benchmark_server(request_count=600, concurrency=16):
+    ''' Load a recommendation server backed by a fake upstream with
+    concurrent clients and report latency percentiles.
+
+    The store and the cache live in a temporary directory and the token
+    bucket is lifted, so only the server itself is measured. Every response
+    is compared with the ranking of the same job computed afterwards, to
+    catch requests leaking state into each other. A search finding nothing
+    has to be answered with 404 and a failing upstream search with 502.
+
+    Parameters
+    ----------
+    request_count: integer
+        the number of requests sent
+
+    concurrency: integer
+        the number of concurrent clients, also the number of workers
+
+    Returns
+    -------
+    boolean
+        True if every request succeeded with the expected ranking
+    '''
+    import tempfile
+    import shutil
+    import urllib.error
+    import urllib.request
+    temp_dir = tempfile.mkdtemp()
+    final_proj.DBNAME = os.path.join(temp_dir, final_proj.DBNAME)
+    final_proj.CACHE_DBNAME = os.path.join(temp_dir, final_proj.CACHE_DBNAME)
+    final_proj.CACHE_FILENAME = os.path.join(temp_dir, final_proj.CACHE_FILENAME)
+    final_proj.TOKEN_BUCKET = final_proj.TokenBucket(rate=10 ** 6, capacity=10 ** 6, daily_limit=10 ** 9)
+
+    upstream = ThreadingHTTPServer(('127.0.0.1', 0), FakeUpstreamRequestHandler)
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+    upstream_url = 'http://127.0.0.1:{}'.format(upstream.server_address[1])
+    final_proj.BASE_URL_SEARCH = upstream_url + '/v3/businesses/search?'
+    final_proj.LOCALE_URL = upstream_url + '/supported_locales'
+
+    jobs = []
+    for city in BENCHMARK_CITIES:
+        for category in BENCHMARK_CATEGORIES:
+            for weights in final_proj.get_weight_profiles():
+                jobs.append({'country': 'united states', 'city': city, 'category': category,
+                    'weights': dict(zip(final_proj.CARE_COLUMNS, weights))})
+    job_list = [jobs[index % len(jobs)] for index in range(request_count)]
+    random.Random(0).shuffle(job_list)
+
+    def post_job(job):
+        request = urllib.request.Request(server_url + '/recommendations', data=json.dumps(job).encode('utf-8'),
+            headers={'Content-Type': 'application/json'})
+        start_time = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request) as response:
+                body = json.loads(response.read())
+        except OSError as error:
+            return job, None, str(error)
+        return job, body, (time.perf_counter() - start_time) * 1000
+
+    def get_status(city):
+        job = {'country': 'united states', 'city': city, 'category': BENCHMARK_CATEGORIES[0],
+            'weights': dict(zip(final_proj.CARE_COLUMNS, final_proj.CARE_WEIGHTS))}
+        request = urllib.request.Request(server_url + '/recommendations', data=json.dumps(job).encode('utf-8'),
+            headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status
+        except urllib.error.HTTPError as error:
+            return error.code
+
+    server = start_server(('127.0.0.1', 0), concurrency)
+    server_url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(post_job, job_list))
+    elapsed = time.perf_counter() - start_time
+    expected_dict = {}
+    for job in jobs:
+        expected_dict[json.dumps(job, sort_keys=True)] = get_recommendations(job, server.ingest_flight)
+    empty_status = get_status(FAKE_UPSTREAM_EMPTY_CITY)
+    failing_status = get_status(FAKE_UPSTREAM_FAILING_CITY)
+
+    failures = [result for result in results if result[1] is None]
+    mismatches = [result for result in results if result[1] is not None and
+        result[1] != expected_dict[json.dumps(result[0], sort_keys=True)]]
+    latencies = sorted(result[2] for result in results if result[1] is not None)
+    server_stats = server.stats()
+    print('Served {} requests from {} concurrent clients in {:0.1f} s ({:0.0f} requests/s)'.format(
+        len(results), concurrency, elapsed, len(results) / elapsed))
+    if len(latencies) > 0:
+        print('Client latency: p50 {:0.1f} ms, p99 {:0.1f} ms, max {:0.1f} ms'.format(
+            final_proj.get_percentile(latencies, 0.5), final_proj.get_percentile(latencies, 0.99), latencies[-1]))
+        print('Server latency: p50 {:0.1f} ms, p99 {:0.1f} ms, max {:0.1f} ms'.format(
+            server_stats['p50_ms'], server_stats['p99_ms'], server_stats['max_ms']))
+    print('Upstream requests: {upstream}, coalesced: {coalesced}'.format(**server_stats['flight']))
+    print('Failed requests: {}, responses differing from their job\'s ranking: {}'.format(len(failures), len(mismatches)))
+    print('Status of a search finding nothing: {}, of a failing upstream search: {}'.format(empty_status, failing_status))
+
+    server.shutdown()
+    server.server_close()
+    upstream.shutdown()
+    upstream.server_close()
+    final_proj.get_db_pool().close_all()
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    return len(failures) == 0 and len(mismatches) == 0 and empty_status == 404 and failing_status == 502
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    if len(sys.argv) == 2 and sys.argv[1] == '--benchmark':
+        sys.exit(0 if benchmark_server() else 1)
+    elif len(sys.argv) == 2:
+        serve(int(sys.argv[1]))
+    else:
+        serve()